@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+from sys import path, stderr, exit
+from os.path import dirname, realpath
+path.insert(0, dirname(dirname(realpath(__file__))))
+from argparse import ArgumentParser
+from timeit import repeat
+from pandas import concat, Series
+from genefab._assay import records_to_frame
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = ArgumentParser(
+        description="Compare per-sample Series construction of assay " +
+        "metadata frames with batched construction on synthetic ISA JSON"
+    )
+    parser.add_argument("-s", "--samples", type=int, default=500)
+    parser.add_argument("-f", "--fields", type=int, default=300)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def make_raw(n_samples, n_fields):
+    """Synthetic `raw` section; every third field is constant across samples"""
+    return [
+        dict(
+            [("sample_name", "Sample-{}".format(i))] + [
+                (
+                    "field_{}".format(j),
+                    "constant" if j % 3 == 0 else "value {}".format((i+j) % 7)
+                )
+                for j in range(n_fields)
+            ]
+        )
+        for i in range(n_samples)
+    ]
+
+
+def legacy_raw_metadata(raw):
+    """Previous construction of Assay.raw_metadata"""
+    return concat(map(Series, raw), axis=1).T
+
+
+def legacy_annotation(raw):
+    """Previous construction and differential filtering in Assay.annotation()"""
+    annotation_dataframe = concat([Series(r) for r in raw], axis=1)
+    differential_rows = annotation_dataframe.apply(
+        lambda r: len(set(r.values))>1, axis=1
+    )
+    annotation_dataframe = annotation_dataframe[differential_rows]
+    return annotation_dataframe.T.set_index("sample_name").T.T
+
+
+def batched_raw_metadata(raw):
+    """Current construction of Assay.raw_metadata"""
+    return records_to_frame(raw)
+
+
+def batched_annotation(raw):
+    """Current construction and differential filtering in Assay.annotation()"""
+    annotation_dataframe = records_to_frame(raw)
+    differential_columns = annotation_dataframe.nunique(dropna=False) > 1
+    annotation_dataframe = annotation_dataframe.loc[
+        :, differential_columns.values
+    ]
+    return annotation_dataframe.set_index("sample_name")
+
+
+def main(args):
+    """Check that both constructions agree and report best timings"""
+    raw = make_raw(args.samples, args.fields)
+    print("{} samples x {} fields".format(args.samples, args.fields + 1))
+    pairs = [
+        ("raw_metadata", legacy_raw_metadata, batched_raw_metadata),
+        ("annotation", legacy_annotation, batched_annotation),
+    ]
+    for name, legacy, batched in pairs:
+        if not legacy(raw).equals(batched(raw)):
+            print("{}: results differ".format(name), file=stderr)
+            return 1
+        legacy_time, batched_time = (
+            min(repeat(lambda: f(raw), number=1, repeat=args.repeat))
+            for f in (legacy, batched)
+        )
+        print("{}: {:.1f} ms -> {:.1f} ms ({:.1f}x)".format(
+            name, legacy_time * 1000, batched_time * 1000,
+            legacy_time / batched_time
+        ))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main(parse_args()))
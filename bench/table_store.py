@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+from sys import path, stderr, exit
+from os.path import dirname, realpath
+path.insert(0, dirname(dirname(realpath(__file__))))
+from argparse import ArgumentParser
+from timeit import repeat
+from tempfile import TemporaryDirectory
+from os import chdir, getcwd, makedirs, path as os_path
+from numpy.random import RandomState
+from pandas import DataFrame
+from genefab._util import STORAGE_PREFIX
+from genefab._sqlite import dump_to_sqlite, try_sqlite
+from genefab._storage import write_arrow_table, read_arrow_date
+from genefab._storage import is_compression_available
+from genefab._dbpool import SQLITE_POOL
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = ArgumentParser(
+        description="Compare footprint and read latency of the multipart " +
+        "SQLite layout and uncompressed/compressed Arrow files on a " +
+        "synthetic processed matrix"
+    )
+    parser.add_argument("-g", "--genes", type=int, default=30000)
+    parser.add_argument("-s", "--samples", type=int, default=600)
+    parser.add_argument("-c", "--codecs", nargs="+", default=["lz4", "zstd"])
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def make_table(n_genes, n_samples):
+    """Normalized counts: rounded floats (as in upstream files) and gene symbols"""
+    table_data = DataFrame(
+        RandomState(0).lognormal(3, 2, size=(n_genes, n_samples)).round(4),
+        columns=["Sample-{}".format(i) for i in range(n_samples)]
+    )
+    table_data.insert(0, "SYMBOL", ["Gene{}".format(i) for i in range(n_genes)])
+    table_data.insert(0, "Unnamed: 0", ["ENSG{:011d}".format(i) for i in range(n_genes)])
+    return table_data
+
+
+def read_arrow(arrow_file):
+    """Same read as genefab._storage.try_arrow()"""
+    return read_arrow_date(arrow_file)[1].read_all().to_pandas(split_blocks=True)
+
+
+def main(args):
+    """Write the table in each layout, check round trip, report sizes and best read timings"""
+    table_data = make_table(args.genes, args.samples)
+    print("{} genes x {} samples".format(args.genes, args.samples))
+    cwd = getcwd()
+    with TemporaryDirectory() as tempdir:
+        chdir(tempdir)
+        try:
+            makedirs(STORAGE_PREFIX)
+            gz_file = os_path.join(tempdir, "source.csv.gz")
+            table_data.to_csv(gz_file, index=False, compression="gzip")
+            layouts = [("source .csv.gz", gz_file, None)]
+            dump_to_sqlite("GLDS-0", "assay", "bench", table_data, set_date=0)
+            db_file = os_path.join(STORAGE_PREFIX, "GLDS-0-assay.sqlite3")
+            with SQLITE_POOL.connection(db_file) as db: # move pages out of -wal
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            layouts.append((
+                "sqlite (multipart)", db_file,
+                lambda: try_sqlite("GLDS-0", "assay", "bench", 0)
+            ))
+            for compression in ["none"] + args.codecs:
+                if (compression != "none") and (not is_compression_available(compression)):
+                    print("{}: codec not available, skipped".format(compression), file=stderr)
+                    continue
+                arrow_file = os_path.join(tempdir, compression + ".arrow")
+                write_arrow_table(
+                    table_data, arrow_file, set_date=0, compression=compression
+                )
+                layouts.append((
+                    "arrow ({})".format(compression), arrow_file,
+                    lambda arrow_file=arrow_file: read_arrow(arrow_file)
+                ))
+            for name, file_name, read in layouts:
+                size = os_path.getsize(file_name)
+                if read is None:
+                    print("{:>20}: {:8.1f} MiB".format(name, size / 2**20))
+                    continue
+                if not read().reset_index(drop=True).equals(table_data):
+                    print("{}: round trip differs".format(name), file=stderr)
+                    return 1
+                read_time = min(repeat(read, number=1, repeat=args.repeat))
+                print("{:>20}: {:8.1f} MiB, read {:8.1f} ms".format(
+                    name, size / 2**20, read_time * 1000
+                ))
+        finally:
+            chdir(cwd)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main(parse_args()))
@@ -1,9 +1,10 @@
 from os.path import join
 from genefab._exceptions import GeneLabJSONException
 from genefab._exceptions import GeneLabException
-from collections import defaultdict
-from pandas import concat, Series, Index, DataFrame, merge
-from re import search, fullmatch, IGNORECASE, sub
+from collections import defaultdict, OrderedDict
+from pandas import Series, Index, DataFrame, merge
+from re import search, fullmatch, IGNORECASE, sub, compile as re_compile
+from threading import Lock
 from genefab._util import DELIM_AS_IS
 from genefab._display import to_cls
 
@@ -16,6 +17,95 @@ ASSAY_PROTOCOL_LIST = [
     "genelab microarray data processing protocol",
     "genelab rnaseq data processing protocol"
 ]
+PATTERN_CACHE_MAXSIZE = 256
+REGEX_METACHARACTERS = set("\\.^$*+?{}[]|()")
+
+
+def records_to_frame(records):
+    """Build object-typed DataFrame from list of dicts in one pass, keeping key order"""
+    columns = list(OrderedDict.fromkeys(
+        key for record in records for key in record
+    ))
+    return DataFrame(data=records, columns=columns, dtype=object)
+
+
+def freeze_frame(dataframe):
+    """Copy of homogeneous dataframe with read-only values, for sharing"""
+    values = dataframe.values.copy()
+    values.flags.writeable = False
+    return DataFrame(values, index=dataframe.index, columns=dataframe.columns)
+
+
+def read_only_view(dataframe):
+    """New dataframe over the same read-only values, with own index and columns"""
+    return DataFrame(
+        dataframe.values, index=dataframe.index.copy(),
+        columns=dataframe.columns.copy()
+    )
+
+
+class PatternIndex():
+    """Matches regexes against a fixed pool of strings; literals skip the regex engine"""
+
+    def __init__(self, pool, maxsize=PATTERN_CACHE_MAXSIZE):
+        """Index pool by exact and lowercase value"""
+        self._pool = tuple(
+            value for value in OrderedDict.fromkeys(pool)
+            if isinstance(value, str)
+        )
+        self._pool_set = set(self._pool)
+        self._lowercase_pool = tuple(value.lower() for value in self._pool)
+        self._by_lowercase = defaultdict(set)
+        for value, lowercase_value in zip(self._pool, self._lowercase_pool):
+            self._by_lowercase[lowercase_value].add(value)
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self._lock = Lock()
+
+    def match(self, pattern, flags=IGNORECASE, method=search):
+        """Set of pool values matching pattern (a fresh set; safe to modify)"""
+        key = pattern, flags, method.__name__
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return set(self._results[key])
+        matches = self._match(pattern, flags, method.__name__)
+        with self._lock:
+            self._results[key] = matches
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return set(matches)
+
+    def _match(self, pattern, flags, method_name):
+        """Find matches with dictionary lookups / substring tests if possible"""
+        is_literal = pattern.isascii() and not (
+            REGEX_METACHARACTERS & set(pattern)
+        )
+        if is_literal and (flags in {0, IGNORECASE}):
+            if flags == IGNORECASE:
+                pattern, pool = pattern.lower(), self._lowercase_pool
+            else:
+                pool = self._pool
+            if method_name == "fullmatch":
+                if flags == IGNORECASE:
+                    return frozenset(self._by_lowercase.get(pattern, ()))
+                else:
+                    return frozenset({pattern} & self._pool_set)
+            elif method_name == "match":
+                test = lambda value: value.startswith(pattern)
+            elif method_name == "search":
+                test = lambda value: pattern in value
+            else:
+                raise ValueError("Unsupported match method: " + method_name)
+            return frozenset(
+                value for value, pool_value in zip(self._pool, pool)
+                if test(pool_value)
+            )
+        else:
+            regex_method = getattr(re_compile(pattern, flags), method_name)
+            return frozenset(
+                value for value in self._pool if regex_method(value)
+            )
 
 
 class AssayMetadataLocator():
@@ -33,10 +123,11 @@ class AssayMetadataLocator():
             except ValueError:
                 raise IndexError("Incorrect index for assay metadata")
             else: # assume both indices and titles are collections of regexes
-                indices = set.union(*({
-                        ix for ix in self.parent.parent.raw_metadata.index
-                        if fullmatch(pattern, ix, flags=IGNORECASE)
-                    } for pattern in index_patterns
+                indices = set.union(*(
+                    self.parent.parent._sample_index.match(
+                        pattern, method=fullmatch
+                    )
+                    for pattern in index_patterns
                 ))
                 row_subset = self.parent.loc[list(indices)]
                 field_titles = set.union(*(
@@ -54,10 +145,11 @@ class AssayMetadataLocator():
                 return self.parent[key]
             elif isinstance(key, (tuple, list, set)):
                 # assume it is a collection of regexes:
-                indices = set.union(*({
-                        ix for ix in self.parent.parent.raw_metadata.index
-                        if fullmatch(pattern, ix, flags=IGNORECASE)
-                    } for pattern in key
+                indices = set.union(*(
+                    self.parent.parent._sample_index.match(
+                        pattern, method=fullmatch
+                    )
+                    for pattern in key
                 ))
                 return self.parent.parent.raw_metadata.loc[list(indices)]
             else: # last resort; just pass it to raw_metadata directly
@@ -140,6 +232,8 @@ class Assay():
     storage = None
     _normalized_data, _processed_data = None, None
     _indexed_by, _name_delim, _field_indexed_by = None, True, None
+    _memo, _memo_lock = None, None
+    _title_index, _sample_index = None, None
 
     def __init__(self, parent, name, json, glds_file_urls, glds_file_dates, storage_prefix, index_by, name_delim):
         """Parse JSON into assay metadata"""
@@ -156,8 +250,9 @@ class Assay():
         for field, title in self._field2title.items():
             self._fields[title].add(field)
         self._fields = dict(self._fields)
+        self._title_index = PatternIndex(self._fields)
         # populate metadata and index with `index_by`:
-        self.raw_metadata = concat(map(Series, self._raw), axis=1).T
+        self.raw_metadata = records_to_frame(self._raw)
         self._field_indexed_by = self._get_unique_field_from_title(index_by)
         maybe_indexed_by = self._match_field_titles(index_by, method=fullmatch)
         if len(maybe_indexed_by) != 1:
@@ -171,20 +266,24 @@ class Assay():
             self.raw_metadata.index = self.raw_metadata.index.map(
                 lambda f: sub(r'[._-]', name_delim, f)
             )
+        self._sample_index = PatternIndex(self.raw_metadata.index)
         del self._fields[self._indexed_by]
         # initialize indexing functions:
         self.metadata = AssayMetadata(self)
+        self._memo, self._memo_lock = {}, Lock()
+
+    def _memoized(self, key, make):
+        """Compute value once per key; if computed concurrently, first one wins"""
+        with self._memo_lock:
+            if key in self._memo:
+                return self._memo[key]
+        value = make()
+        with self._memo_lock:
+            return self._memo.setdefault(key, value)
 
     def _match_field_titles(self, pattern, flags=IGNORECASE, method=search):
         """Find fields matching pattern"""
-        if self._indexed_by:
-            field_pool = set(self._fields) | {self._indexed_by}
-        else:
-            field_pool = self._fields
-        return {
-            title for title in field_pool
-            if method(pattern, title, flags=flags)
-        }
+        return self._title_index.match(pattern, flags=flags, method=method)
 
     def _get_unique_field_from_title(self, title):
         """Get unique raw metadata column name; fail if anything is ambiguous"""
@@ -229,6 +328,23 @@ class Assay():
 
     def annotation(self, differential_annotation=True, named_only=True, index_by="Sample Name", cls=None, continuous="infer"):
         """Get annotation of samples: entries that differ (default) or all entries"""
+        args = differential_annotation, named_only, index_by
+        annotation_dataframe = self._memoized(
+            ("annotation",) + args,
+            lambda: freeze_frame(self._make_annotation(*args))
+        )
+        if cls:
+            return self._memoized(
+                ("annotation_cls",) + args + (cls, continuous),
+                lambda: to_cls(
+                    annotation_dataframe, target=cls, continuous=continuous
+                )
+            )
+        else:
+            return read_only_view(annotation_dataframe)
+
+    def _make_annotation(self, differential_annotation, named_only, index_by):
+        """Build annotation of samples from raw samples JSON"""
         samples_keys = set(self.parent.samples.keys())
         if len(samples_keys) == 1:
             samples_key = samples_keys.pop()
@@ -237,62 +353,68 @@ class Assay():
         if samples_key not in self.parent.samples:
             error_message = "Could not find an unambiguous samples key"
             raise GeneLabJSONException(error_message)
-        annotation_dataframe = concat([
-            Series(raw_sample_annotation)
-            for raw_sample_annotation in self.parent.samples[samples_key]["raw"]
-        ], axis=1)
+        annotation_dataframe = records_to_frame(
+            self.parent.samples[samples_key]["raw"]
+        )
         samples_field2title = {
             entry["field"]: entry["title"]
             for entry in self.parent.samples[samples_key]["header"]
         }
         if named_only:
-            index_subset = [
-                field for field in annotation_dataframe.index
+            annotation_dataframe = annotation_dataframe[[
+                field for field in annotation_dataframe.columns
                 if field in samples_field2title
-            ]
-            annotation_dataframe = annotation_dataframe.loc[index_subset]
-        annotation_dataframe.index = annotation_dataframe.index.map(
+            ]]
+        annotation_dataframe.columns = annotation_dataframe.columns.map(
             lambda field: samples_field2title.get(field, field)
         )
         if differential_annotation:
-            differential_rows = annotation_dataframe.apply(
-                lambda r: len(set(r.values))>1, axis=1
-            )
-            annotation_dataframe = annotation_dataframe[differential_rows]
-        annotation_dataframe = annotation_dataframe.T.set_index(index_by).T
+            differential_columns = annotation_dataframe.nunique(dropna=False) > 1
+            annotation_dataframe = annotation_dataframe.loc[
+                :, differential_columns.values
+            ]
+        annotation_dataframe = annotation_dataframe.set_index(index_by)
         if self._name_delim != DELIM_AS_IS:
-            annotation_dataframe.columns = annotation_dataframe.columns.map(
+            annotation_dataframe.index = annotation_dataframe.index.map(
                 lambda f: sub(r'[._-]', self._name_delim, f)
             )
-        annotation_dataframe.columns.name = index_by
-        if cls:
-            return to_cls(
-                annotation_dataframe.T, target=cls, continuous=continuous
-            )
-        else:
-            return annotation_dataframe.T
+        annotation_dataframe.index.name = index_by
+        return annotation_dataframe
 
     def factors(self, cls=None, continuous="infer"):
         """Get DataFrame of samples and factors in human-readable form"""
+        factors_dataframe = self._memoized(
+            ("factors",), lambda: freeze_frame(self._make_factors())
+        )
+        if cls is not None:
+            return self._memoized(
+                ("factors_cls", cls, continuous),
+                lambda: self._factors_to_cls(factors_dataframe, cls, continuous)
+            )
+        else:
+            return read_only_view(factors_dataframe)
+
+    def _make_factors(self):
+        """Select factor fields from annotation"""
         annotation = self.annotation()
         factor_fields = [
             field for field in annotation.columns
             if search(r'^factor value', field, flags=IGNORECASE)
         ]
-        factors_dataframe = annotation[factor_fields]
-        factors_dataframe.index.name, factors_dataframe.columns.name = (
-            self._indexed_by, "Factor"
+        return (
+            annotation[factor_fields]
+            .rename_axis(self._indexed_by, axis="index")
+            .rename_axis("Factor", axis="columns")
         )
+
+    def _factors_to_cls(self, factors_dataframe, cls, continuous):
+        """Convert factors to CLS for one factor (or the only one, if '*')"""
         if cls == "*":
             if factors_dataframe.shape[1] != 1:
                 raise KeyError("one of multiple factors needs to be specified")
             else:
                 cls = str(factors_dataframe.columns[0])
-            return to_cls(factors_dataframe, target=cls, continuous=continuous)
-        elif cls is not None:
-            return to_cls(factors_dataframe, target=cls, continuous=continuous)
-        else:
-            return factors_dataframe
+        return to_cls(factors_dataframe, target=cls, continuous=continuous)
 
     def _get_file_url(self, filemask):
         """Get URL of file defined by file mask (such as *SRR1781971_*)"""
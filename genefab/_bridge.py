@@ -1,19 +1,16 @@
-from genefab import GLDS, GeneLabJSONException
+from genefab import GeneLabJSONException
+from genefab._cache import GLDS_CACHE
+from genefab._query import parse_filters, get_frame_column_getter
+from genefab._query import parse_top, stable_top_k
+from genefab._metrics import METRICS
 from re import sub, split, search
 from pandas import DataFrame
-from operator import __lt__, __le__, __eq__, __ne__, __ge__, __gt__
-
-
-OPERATOR_MAPPER = {
-    "<": __lt__, "<=": __le__, ">=": __ge__, ">": __gt__,
-    "==": __eq__, "!=": __ne__
-}
 
 
 def get_assay(accession, assay_name, rargs, get_json):
     """Get assay object via GLDS accession and assay name"""
     try:
-        glds = GLDS(
+        glds = GLDS_CACHE.get(
             accession, get_json=get_json,
             name_delim=rargs.data_rargs["name_delim"]
         )
@@ -60,6 +57,7 @@ def filter_metadata_cells(subset, filename_filter):
     return filtered_values
 
 
+@METRICS.timed("resolve_file_name")
 def resolve_file_name(assay, rargs):
     """Find single file in metadata matching given request arguments for assay"""
     if rargs.data_rargs.get("fields", None) is False:
@@ -86,57 +84,41 @@ def resolve_file_name(assay, rargs):
 
 def get_filtered_repr_df(repr_df, field_filters_raw):
     """Interpret the filter request argument and subset the repr dataframe"""
-    if not isinstance(field_filters_raw, (list, tuple, set)):
-        field_filters = [field_filters_raw]
+    expression = parse_filters(field_filters_raw, columns=repr_df.columns)
+    if expression is None:
+        return repr_df
     else:
-        field_filters = field_filters_raw
-    indexer = None
-    for field_filter in field_filters:
-        field_filter_stripped = sub(r'(^\')|(\'$)', "", field_filter)
-        match = search(r'(^[^<>=]+)([<>=]+)(.+)$', field_filter_stripped)
-        if not match:
-            raise ValueError("Malformed `filter`")
-        field, comparison, value = match.groups()
-        if comparison not in OPERATOR_MAPPER:
-            error_mask = "Bad comparison: '{}'"
-            raise ValueError(error_mask.format(comparison))
-        else:
-            compare = OPERATOR_MAPPER[comparison]
-        if field not in repr_df.columns:
-            error_mask = "Unknown field (column): '{}'"
-            raise ValueError(error_mask.format(field))
-        try:
-            value = float(value)
-        except ValueError:
-            if value == "True":
-                value = True
-            elif value == "False":
-                value = False
-        try:
-            field_indexer = compare(repr_df[field], value)
-        except TypeError:
-            emsk = "Invalid comparison (TypeError): '{}' is `{}` and {} is `{}`"
-            raise TypeError(emsk.format(
-                field, repr_df[field].dtype, value, type(value).__name__
-            ))
-        if indexer is None:
-            indexer = field_indexer
-        else:
-            indexer &= field_indexer
-    return repr_df[indexer]
+        return repr_df[expression.evaluate(get_frame_column_getter(repr_df))]
+
 
+def iterate_filtered_blocks(blocks, field_filters_raw):
+    """Apply the filter request argument to blocks that share columns"""
+    expression = None
+    for block in blocks:
+        if expression is None:
+            expression = parse_filters(field_filters_raw, columns=block.columns)
+        yield block[expression.evaluate(get_frame_column_getter(block))]
 
-def filter_table_data(repr_df, data_filter_rargs):
-    """Filter dataframe"""
+
+@METRICS.timed("filter_table_data")
+def filter_table_data(repr_df, data_filter_rargs, top=None):
+    """Filter dataframe; with `top`, only the first `top` sorted rows are ordered"""
     if data_filter_rargs["filter"] is not None:
         repr_df = get_filtered_repr_df(repr_df, data_filter_rargs["filter"])
     if data_filter_rargs["sort_by"] is not None:
         sort_by = sub(r'(^\')|(\'$)', "", data_filter_rargs["sort_by"])
-        if sort_by in repr_df.columns:
+        if sort_by not in repr_df.columns:
+            error_mask = "Unknown field (column) '{}'"
+            raise IndexError(error_mask.format(sort_by))
+        limit = parse_top(top)
+        if limit is None:
             repr_df = repr_df.sort_values(
-                by=sort_by, ascending=data_filter_rargs["ascending"]
+                by=sort_by, ascending=data_filter_rargs["ascending"],
+                kind="mergesort"
             )
         else:
-            error_mask = "Unknown field (column) '{}'"
-            raise IndexError(error_mask.format(sort_by))
+            repr_df = repr_df.iloc[stable_top_k(
+                get_frame_column_getter(repr_df)(sort_by), limit,
+                ascending=data_filter_rargs["ascending"]
+            )]
     return repr_df
@@ -0,0 +1,285 @@
+from genefab._util import STORAGE_PREFIX, TTL_CACHE_DIR, TEMPORARY_FILE_PREFIX
+from genefab._sqlite import destroy_multipart_sql_table
+from genefab._dbpool import SQLITE_POOL
+from os import environ, path, walk, remove, makedirs, getpid
+from threading import Lock, Thread
+from contextlib import closing
+from sqlite3 import connect, OperationalError
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from time import time, sleep
+from sys import stderr
+
+
+STORAGE_BUDGET_BYTES = int(environ.get("GENEFAB_STORAGE_BUDGET", 0)) # 0: no limit
+STORAGE_HIGH_WATERMARK = float(
+    environ.get("GENEFAB_STORAGE_HIGH_WATERMARK", .9) # fraction of budget
+)
+STORAGE_LOW_WATERMARK = float(environ.get("GENEFAB_STORAGE_LOW_WATERMARK", .7))
+STORAGE_EVICTION_POLICY = environ.get("GENEFAB_STORAGE_EVICTION_POLICY", "lru")
+STORAGE_CHECK_INTERVAL = float(environ.get("GENEFAB_STORAGE_CHECK_INTERVAL", 300))
+STORAGE_VACUUM_FREE_RATIO = float(
+    environ.get("GENEFAB_STORAGE_VACUUM_FREE_RATIO", .25)
+)
+ACCESS_DB_NAME = "access.sqlite3"
+ACCESS_SCHEMA = "('kind' TEXT, 'location' TEXT, 'name' TEXT, 'accessed' INTEGER, 'hits' INTEGER, PRIMARY KEY ('kind', 'location', 'name'))"
+BUDGET_LOCK_NAME = "budget.lock"
+UNTRACKED_DB_NAMES = {"log.sqlite3", ACCESS_DB_NAME}
+EVICTABLE_FILE_EXTENSIONS = (".arrow", ".gct")
+LOCK_FILE_EXTENSION = ".lock" # empty, and held with flock(), so never removed
+
+
+class StorageBudget():
+    """Tracks use of stored tables and keeps the stores between watermarks of a byte budget"""
+    runs, evicted, evicted_bytes, vacuumed, usage = 0, 0, 0, 0, None
+    removed_temporary = 0
+
+    def __init__(self, storage_prefix=STORAGE_PREFIX, cache_dirs=(TTL_CACHE_DIR,), budget=STORAGE_BUDGET_BYTES, high_watermark=STORAGE_HIGH_WATERMARK, low_watermark=STORAGE_LOW_WATERMARK, policy=STORAGE_EVICTION_POLICY, interval=STORAGE_CHECK_INTERVAL, vacuum_free_ratio=STORAGE_VACUUM_FREE_RATIO):
+        """Store settings; the background thread is started on first use in each process"""
+        if policy not in {"lru", "lfu"}:
+            raise ValueError("Unknown eviction policy: '{}'".format(policy))
+        if not (0 < low_watermark <= high_watermark):
+            raise ValueError("Watermarks must satisfy 0 < low <= high")
+        self.storage_prefix, self.cache_dirs = storage_prefix, tuple(cache_dirs)
+        self.budget, self.policy = budget, policy
+        self.high_watermark, self.low_watermark = high_watermark, low_watermark
+        self.interval, self.vacuum_free_ratio = interval, vacuum_free_ratio
+        self.access_db_name = path.join(storage_prefix, ACCESS_DB_NAME)
+        self._pending = {} # (kind, location, name) -> [accessed, hits]
+        self._lock = Lock()
+        self._thread_pid = None
+
+    def touch(self, kind, location, name=""):
+        """Record use of a stored file ('file') or of a table in a database ('sqlite')"""
+        with self._lock:
+            pending = self._pending.setdefault((kind, location, name), [0, 0])
+            pending[0], pending[1] = int(time()), pending[1] + 1
+            if self._thread_pid != getpid(): # threads do not survive fork
+                self._thread_pid = getpid()
+                Thread(target=self._run_forever, daemon=True).start()
+
+    def _run_forever(self):
+        """Background loop"""
+        while True:
+            sleep(self.interval)
+            try:
+                self.run()
+            except Exception as e:
+                print("Warning: storage maintenance failed:", e, file=stderr)
+
+    def run(self):
+        """Flush access records, compact databases, evict down to low watermark if above high"""
+        self.flush()
+        makedirs(self.storage_prefix, exist_ok=True)
+        lock_name = path.join(self.storage_prefix, BUDGET_LOCK_NAME)
+        with open(lock_name, "a") as handle:
+            try: # only one process does maintenance at a time
+                flock(handle, LOCK_EX | LOCK_NB)
+            except OSError:
+                return
+            try:
+                self.compact()
+                self.remove_stale_temporary_files()
+                usage = self.get_usage()
+                if self.budget and (usage > self.high_watermark * self.budget):
+                    self.evict(usage, self.low_watermark * self.budget)
+                    usage = self.get_usage()
+                with self._lock:
+                    self.runs += 1
+                    self.usage = usage
+            finally:
+                flock(handle, LOCK_UN)
+
+    def flush(self):
+        """Write pending access records to the access database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        makedirs(self.storage_prefix, exist_ok=True)
+        with SQLITE_POOL.connection(self.access_db_name) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS 'access' " + ACCESS_SCHEMA)
+                db.executemany(
+                    "INSERT OR IGNORE INTO 'access' VALUES (?, ?, ?, 0, 0)",
+                    list(pending)
+                )
+                db.executemany(
+                    "UPDATE 'access' SET accessed = max(accessed, ?), " +
+                    "hits = hits + ? WHERE kind = ? AND location = ? AND name = ?",
+                    [(a, h, *key) for key, (a, h) in pending.items()]
+                )
+
+    def read_access_records(self):
+        """Last access time and number of accesses by unit"""
+        if not path.isfile(self.access_db_name):
+            return {}
+        with SQLITE_POOL.connection(self.access_db_name) as db:
+            try:
+                return {
+                    (kind, location, name): (accessed, hits)
+                    for kind, location, name, accessed, hits in db.execute(
+                        "SELECT kind, location, name, accessed, hits " +
+                        "FROM 'access'"
+                    )
+                }
+            except OperationalError:
+                return {}
+
+    def forget(self, units):
+        """Remove access records of evicted units"""
+        if units and path.isfile(self.access_db_name):
+            with SQLITE_POOL.connection(self.access_db_name) as db:
+                with db:
+                    db.executemany(
+                        "DELETE FROM 'access' WHERE " +
+                        "kind = ? AND location = ? AND name = ?", units
+                    )
+
+    def iterate_files(self):
+        """All files in the table store and cache directories, except lock files"""
+        for root in (self.storage_prefix,) + self.cache_dirs:
+            for dirpath, _, filenames in walk(root):
+                for filename in filenames:
+                    if not filename.endswith(LOCK_FILE_EXTENSION):
+                        yield path.join(dirpath, filename)
+
+    def get_usage(self):
+        """Total size of the table store and cache directories"""
+        usage = 0
+        for file_name in self.iterate_files():
+            try:
+                usage += path.getsize(file_name)
+            except OSError: # removed in the meantime
+                pass
+        return usage
+
+    def iterate_databases(self):
+        """Per-assay SQLite databases"""
+        for file_name in self.iterate_files():
+            basename = path.basename(file_name)
+            if basename.endswith(".sqlite3") and (basename not in UNTRACKED_DB_NAMES):
+                yield file_name
+
+    def iterate_units(self):
+        """Evictable units with estimated size and modification time"""
+        for file_name in self.iterate_files():
+            basename = path.basename(file_name)
+            in_cache_dirs = any(
+                path.dirname(file_name).startswith(cache_dir)
+                for cache_dir in self.cache_dirs
+            )
+            is_evictable = basename.endswith(EVICTABLE_FILE_EXTENSIONS) or (
+                in_cache_dirs and not basename.startswith("__wz_cache")
+            )
+            if is_evictable:
+                try:
+                    yield ("file", file_name, ""), (
+                        path.getsize(file_name), path.getmtime(file_name)
+                    )
+                except OSError:
+                    pass
+        for db_name in self.iterate_databases():
+            try:
+                db_size, db_mtime = path.getsize(db_name), path.getmtime(db_name)
+                if path.isfile(db_name + "-wal"): # emptied by vacuum()
+                    db_size += path.getsize(db_name + "-wal")
+                with SQLITE_POOL.connection(db_name) as db:
+                    table_names = [
+                        name for name, in
+                        db.execute("SELECT name FROM 'table_dates'")
+                    ]
+            except (OSError, OperationalError):
+                continue
+            for table_name in table_names: # size is not known per table
+                yield ("sqlite", db_name, table_name), (
+                    db_size / len(table_names), db_mtime
+                )
+
+    def evict(self, usage, target):
+        """Remove least recently (or frequently) used units until usage is below target"""
+        records = self.read_access_records()
+        def priority(unit_info):
+            unit, (_, mtime) = unit_info
+            accessed, hits = records.get(unit, (mtime, 0))
+            return (accessed,) if self.policy == "lru" else (hits, accessed)
+        evicted_units, dirty_db_names = [], set()
+        for unit, (size, _) in sorted(self.iterate_units(), key=priority):
+            if usage <= target:
+                break
+            kind, location, name = unit
+            try:
+                if kind == "file":
+                    remove(location)
+                else:
+                    with SQLITE_POOL.connection(location) as db, db.transaction():
+                        destroy_multipart_sql_table(name, db)
+                    dirty_db_names.add(location)
+            except (OSError, OperationalError):
+                continue
+            usage -= size
+            evicted_units.append(unit)
+            with self._lock:
+                self.evicted += 1
+                self.evicted_bytes += int(size)
+        for db_name in dirty_db_names:
+            self.vacuum(db_name)
+        self.forget(evicted_units)
+
+    def vacuum(self, db_name):
+        """Rebuild database file without free pages; skipped if the database is busy"""
+        try:
+            with closing(connect(db_name, timeout=1)) as db:
+                db.execute("VACUUM")
+                # in WAL mode, the rebuilt pages are in the WAL until checkpoint:
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        except OperationalError:
+            return
+        with self._lock:
+            self.vacuumed += 1
+
+    def compact(self):
+        """Vacuum databases with many free pages (left by replaced tables)"""
+        for db_name in self.iterate_databases():
+            try:
+                with SQLITE_POOL.connection(db_name) as db:
+                    page_count, = db.execute("PRAGMA page_count").fetchone()
+                    freelist_count, = db.execute(
+                        "PRAGMA freelist_count"
+                    ).fetchone()
+            except OperationalError:
+                continue
+            if page_count and (
+                    freelist_count / page_count > self.vacuum_free_ratio):
+                self.vacuum(db_name)
+
+    def remove_stale_temporary_files(self):
+        """Remove temporary files not written to for a check interval (left by interrupted writes)"""
+        cutoff = time() - self.interval
+        for file_name in self.iterate_files():
+            if not path.basename(file_name).startswith(TEMPORARY_FILE_PREFIX):
+                continue
+            try:
+                if path.getmtime(file_name) >= cutoff:
+                    continue
+                remove(file_name)
+            except OSError: # renamed or removed in the meantime
+                continue
+            with self._lock:
+                self.removed_temporary += 1
+
+    @property
+    def stats(self):
+        """Settings and counters of maintenance runs"""
+        with self._lock:
+            return {
+                "budget": self.budget, "policy": self.policy,
+                "high_watermark": self.high_watermark,
+                "low_watermark": self.low_watermark,
+                "usage": self.usage, "runs": self.runs,
+                "evicted": self.evicted, "evicted_bytes": self.evicted_bytes,
+                "vacuumed": self.vacuumed,
+                "removed_temporary": self.removed_temporary,
+            }
+
+
+STORAGE_BUDGET = StorageBudget()
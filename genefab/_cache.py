@@ -0,0 +1,234 @@
+from genefab._dataset import GeneLabDataSet
+from genefab._util import DELIM_DEFAULT
+from genefab._shared import SHARED_TABLES
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from os import environ, path, makedirs, listdir, remove, replace, utime
+from tempfile import NamedTemporaryFile
+from json import dumps, loads
+from re import sub
+
+
+GLDS_CACHE_MAXSIZE = 64
+RESPONSE_CACHE_MAXBYTES = int(
+    environ.get("GENEFAB_RESPONSE_CACHE_MAXBYTES", 256*1024*1024)
+)
+RESPONSE_CACHE_ENTRY_MAXBYTES = int(
+    environ.get("GENEFAB_RESPONSE_CACHE_ENTRY_MAXBYTES", 32*1024*1024)
+)
+RESPONSE_CACHE_DIR = environ.get("GENEFAB_RESPONSE_CACHE_DIR") or None
+RESPONSE_CACHE_DISK_MAXBYTES = int(
+    environ.get("GENEFAB_RESPONSE_CACHE_DISK_MAXBYTES", 2*1024*1024*1024)
+)
+
+RenderedResponse = namedtuple(
+    "RenderedResponse", ["body", "is_gzipped", "mimetype", "headers"]
+)
+
+
+class GeneLabDataSetCache():
+    """Bounded process-level LRU cache of GeneLabDataSet objects"""
+    hits, misses, invalidations, evictions = 0, 0, 0, 0
+
+    def __init__(self, maxsize=GLDS_CACHE_MAXSIZE, on_invalidate=None):
+        """Initialize empty cache; `on_invalidate(accession)` is called when dates change"""
+        self.maxsize = maxsize
+        self.on_invalidate = on_invalidate
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, accession, get_json, name_delim=DELIM_DEFAULT):
+        """Get cached GLDS; rebuild if upstream file dates have changed"""
+        key = (accession, name_delim)
+        with self._lock:
+            glds = self._entries.get(key)
+            if glds is not None:
+                self._entries.move_to_end(key)
+        if glds is not None:
+            if glds.get_files_info("dates") == glds.glds_file_dates:
+                with self._lock:
+                    self.hits += 1
+                return glds
+            with self._lock:
+                self.invalidations += 1
+            if self.on_invalidate is not None:
+                self.on_invalidate(accession)
+        glds = GeneLabDataSet(accession, get_json, name_delim=name_delim)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = glds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return glds
+
+    def clear(self):
+        """Drop all cached objects"""
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            return {
+                "size": len(self._entries), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+
+class RenderedResponseCache():
+    """Process-level LRU cache of rendered bodies, bounded by total bytes, with optional disk tier"""
+    hits, disk_hits, misses, stores, evictions, invalidations = 0, 0, 0, 0, 0, 0
+
+    def __init__(self, maxbytes=RESPONSE_CACHE_MAXBYTES, entry_maxbytes=RESPONSE_CACHE_ENTRY_MAXBYTES, cache_dir=RESPONSE_CACHE_DIR, disk_maxbytes=RESPONSE_CACHE_DISK_MAXBYTES):
+        """Initialize empty cache; without `cache_dir`, entries are kept in memory only"""
+        self.maxbytes, self.entry_maxbytes = maxbytes, entry_maxbytes
+        self.cache_dir, self.disk_maxbytes = cache_dir, disk_maxbytes
+        self._entries = OrderedDict() # key -> (tag, RenderedResponse)
+        self._nbytes = 0
+        self._lock = Lock()
+
+    def _get_file_name(self, key, tag):
+        """Disk tier files are prefixed by tag so that they can be invalidated together"""
+        return path.join(
+            self.cache_dir, "{}.{}.response".format(
+                sub(r'[^0-9A-Za-z_-]', "_", tag), key
+            )
+        )
+
+    def _remember(self, key, tag, entry):
+        """Put entry into memory tier and evict least recently used ones; call with lock"""
+        if key in self._entries:
+            self._nbytes -= len(self._entries.pop(key)[1].body)
+        self._entries[key] = tag, entry
+        self._nbytes += len(entry.body)
+        while self._nbytes > self.maxbytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._nbytes -= len(evicted.body)
+            self.evictions += 1
+
+    def get(self, key, tag):
+        """Cached RenderedResponse or None; disk hits are promoted to memory"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][1]
+        entry = self._read(key, tag) if self.cache_dir else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._remember(key, tag, entry)
+        return entry
+
+    def put(self, key, tag, entry):
+        """Store RenderedResponse unless it is larger than allowed for one entry"""
+        if len(entry.body) > min(self.entry_maxbytes, self.maxbytes):
+            return
+        with self._lock:
+            self.stores += 1
+            self._remember(key, tag, entry)
+        if self.cache_dir:
+            self._write(key, tag, entry)
+
+    def _read(self, key, tag):
+        """Read entry from disk tier"""
+        file_name = self._get_file_name(key, tag)
+        try:
+            with open(file_name, "rb") as handle:
+                metadata = loads(handle.readline().decode("utf-8"))
+                body = handle.read()
+            utime(file_name) # recently used
+        except (OSError, ValueError):
+            return None
+        return RenderedResponse(
+            body, metadata["is_gzipped"], metadata["mimetype"],
+            metadata["headers"]
+        )
+
+    def _write(self, key, tag, entry):
+        """Write entry to disk tier atomically, then trim disk tier to its size"""
+        makedirs(self.cache_dir, exist_ok=True)
+        metadata = {
+            "is_gzipped": entry.is_gzipped, "mimetype": entry.mimetype,
+            "headers": entry.headers,
+        }
+        with NamedTemporaryFile(dir=self.cache_dir, delete=False, suffix=".tmp") as tmp:
+            tmp.write(dumps(metadata).encode("utf-8") + b"\n")
+            tmp.write(entry.body)
+        replace(tmp.name, self._get_file_name(key, tag))
+        self._trim_disk()
+
+    def _trim_disk(self):
+        """Remove least recently used files of the disk tier beyond its size"""
+        files = []
+        for basename in listdir(self.cache_dir):
+            file_name = path.join(self.cache_dir, basename)
+            if basename.endswith(".response"):
+                try:
+                    files.append((
+                        path.getmtime(file_name), path.getsize(file_name),
+                        file_name
+                    ))
+                except OSError:
+                    pass
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total <= self.disk_maxbytes:
+                break
+            try:
+                remove(file_name)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, tag):
+        """Drop all entries with tag (e.g. of a dataset whose file dates changed)"""
+        with self._lock:
+            for key in [k for k, (t, _) in self._entries.items() if t == tag]:
+                self._nbytes -= len(self._entries.pop(key)[1].body)
+                self.invalidations += 1
+        if self.cache_dir and path.isdir(self.cache_dir):
+            prefix = sub(r'[^0-9A-Za-z_-]', "_", tag) + "."
+            for basename in listdir(self.cache_dir):
+                if basename.startswith(prefix) and basename.endswith(".response"):
+                    try:
+                        remove(path.join(self.cache_dir, basename))
+                    except OSError:
+                        pass
+
+    def clear(self):
+        """Drop all entries held in memory"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    @property
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            return {
+                "size": len(self._entries), "bytes": self._nbytes,
+                "maxbytes": self.maxbytes, "hits": self.hits,
+                "disk_hits": self.disk_hits, "misses": self.misses,
+                "stores": self.stores, "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+RESPONSE_CACHE = RenderedResponseCache()
+
+
+def invalidate_accession(accession):
+    """Drop rendered responses and shared tables of a dataset whose file dates have changed"""
+    RESPONSE_CACHE.invalidate(accession)
+    SHARED_TABLES.invalidate(accession)
+
+
+GLDS_CACHE = GeneLabDataSetCache(on_invalidate=invalidate_accession)
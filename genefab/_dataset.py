@@ -5,24 +5,97 @@ from genefab._util import FFIELD_ALIASES, FFIELD_VALUES, API_ROOT, GENELAB_ROOT
 from genefab._util import DELIM_DEFAULT, STORAGE_PREFIX
 from genefab._exceptions import GeneLabJSONException
 from genefab._assay import AssayDispatcher
+from genefab._metrics import METRICS
 from pandas import DataFrame, concat
 from os.path import join
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import get_running_loop
+from contextvars import copy_context
+
+
+METADATA_FETCHER = ThreadPoolExecutor(max_workers=16)
 
 
 class GeneLabDataSet():
     """Stores GLDS metadata associated with an accession number"""
     accession, assays, storage = None, None, None
+    glds_file_urls, glds_file_dates = None, None
     verbose = False
 
+    @METRICS.timed("GeneLabDataSet")
     def __init__(self, accession, get_json, verbose=False, storage_prefix=STORAGE_PREFIX, index_by="Sample Name", name_delim=DELIM_DEFAULT):
         """Request JSON representation of ISA metadata and store fields"""
+        data_url, urls_url = self._init_fields(
+            accession, get_json, verbose, storage_prefix
+        )
+        # fetches run in a copy of the request context, so their timings count:
+        data_future = METADATA_FETCHER.submit(
+            copy_context().run, self.get_json, data_url
+        )
+        urls_future = METADATA_FETCHER.submit(
+            copy_context().run, self.get_json, urls_url
+        )
+        self._parse_data_json(data_future.result())
+        dates_json = self.get_json(self._get_json_url("dates"))
+        self._init_assays(
+            urls_json=urls_future.result(), dates_json=dates_json,
+            index_by=index_by, name_delim=name_delim
+        )
+
+    @classmethod
+    async def create_async(cls, accession, get_json, verbose=False, storage_prefix=STORAGE_PREFIX, index_by="Sample Name", name_delim=DELIM_DEFAULT):
+        """Same as constructor, but awaitable; blocking get_json runs in threads"""
+        self = cls.__new__(cls)
+        data_url, urls_url = self._init_fields(
+            accession, get_json, verbose, storage_prefix
+        )
+        loop = get_running_loop()
+        fetch = lambda url: loop.run_in_executor(
+            METADATA_FETCHER, copy_context().run, self.get_json, url
+        )
+        data_future, urls_future = fetch(data_url), fetch(urls_url)
+        self._parse_data_json(await data_future)
+        dates_json = await fetch(self._get_json_url("dates"))
+        self._init_assays(
+            urls_json=await urls_future, dates_json=dates_json,
+            index_by=index_by, name_delim=name_delim
+        )
+        return self
+
+    def _init_fields(self, accession, get_json, verbose, storage_prefix):
+        """Store arguments; return URLs of study and files JSON, which can be fetched concurrently"""
         self.accession = accession
         self.verbose = verbose
         self.storage = join(storage_prefix, accession)
         self.get_json = get_json
-        data_json = self.get_json(
-            "{}/data/study/data/{}/".format(API_ROOT, accession)
-        )
+        # files JSON does not depend on study JSON, dates JSON only needs _id;
+        # URLs are built before any fetch, so an invalid accession fails early:
+        return self._get_json_url("data"), self._get_json_url("urls")
+
+    def _get_json_url(self, kind):
+        """URL of study JSON ('data'), files JSON ('urls'), or dates JSON"""
+        if self.accession is None:
+            raise ValueError("Uninitialized GLDS instance")
+        elif kind == "data":
+            return "{}/data/study/data/{}/".format(API_ROOT, self.accession)
+        elif kind == "urls":
+            acc_nr_match = search(r'\d+$', self.accession)
+            if acc_nr_match is None:
+                raise GeneLabJSONException(
+                    "Invalid accession: '{}'".format(self.accession)
+                )
+            acc_nr = acc_nr_match.group()
+            return "{}/data/glds/files/{}".format(API_ROOT, acc_nr)
+        elif kind == "dates":
+            return "{}/data/study/filelistings/{}".format(
+                API_ROOT, self.internal_id
+            )
+        else:
+            raise ValueError("Unrecognized parameter: '{}'".format(kind))
+
+    def _parse_data_json(self, data_json):
+        """Store fields of study JSON"""
         if len(data_json) == 0:
             raise GeneLabJSONException("Invalid JSON (GLDS does not exist?)")
         if len(data_json) > 1:
@@ -40,10 +113,15 @@ class GeneLabDataSet():
         except KeyError:
             error_message = "Malformed JSON ({})".format(self.accession)
             raise GeneLabJSONException(error_message)
+
+    def _init_assays(self, urls_json, dates_json, index_by, name_delim):
+        """Store file information and parse assays"""
+        self.glds_file_urls = self._parse_files_info("urls", urls_json)
+        self.glds_file_dates = self._parse_files_info("dates", dates_json)
         self.assays = AssayDispatcher(
             parent=self, json=self._info["assays"], storage_prefix=self.storage,
-            name_delim=name_delim, glds_file_urls=self.get_files_info("urls"),
-            index_by=index_by, glds_file_dates=self.get_files_info("dates")
+            name_delim=name_delim, glds_file_urls=self.glds_file_urls,
+            index_by=index_by, glds_file_dates=self.glds_file_dates
         )
 
     @property
@@ -51,6 +129,11 @@ class GeneLabDataSet():
         """List factors"""
         return [fi["factor"] for fi in self.description["factors"]]
 
+    @property
+    def date(self):
+        """Latest date among files of the dataset, metadata files included"""
+        return max(self.glds_file_dates.values(), default=-1)
+
     @property
     def summary_dataframe(self):
         """List factors, assay names and types"""
@@ -67,14 +150,13 @@ class GeneLabDataSet():
 
     def get_files_info(self, kind="urls"):
         """Get filenames and associated URLs"""
-        if self.accession is None:
-            raise ValueError("Uninitialized GLDS instance")
-        elif kind == "urls":
-            getter_url = "{}/data/glds/files/{}"
-            acc_nr = search(r'\d+$', self.accession).group()
-            files_json = self.get_json(
-                getter_url.format(API_ROOT, acc_nr)
-            )
+        return self._parse_files_info(
+            kind, self.get_json(self._get_json_url(kind))
+        )
+
+    def _parse_files_info(self, kind, files_json):
+        """Convert files JSON to filenames and URLs or dates"""
+        if kind == "urls":
             try:
                 filedata = files_json["studies"][self.accession]["study_files"]
             except KeyError:
@@ -84,15 +166,35 @@ class GeneLabDataSet():
                 for fd in filedata
             }
         elif kind == "dates":
-            getter_url = "{}/data/study/filelistings/{}"
-            filedata = self.get_json(
-                getter_url.format(API_ROOT, self.internal_id)
-            )
-            return {fd["file_name"]: date2stamp(fd) for fd in filedata}
+            return {fd["file_name"]: date2stamp(fd) for fd in files_json}
         else:
             raise ValueError("Unrecognized parameter: '{}'".format(kind))
 
 
+def get_datasets(get_json, maxcount=1000, datatype="cgene", verbose=False, **ffield_kwargs):
+    """Get accessions of datasets that match all passed ffield regexes"""
+    accessions = None
+    search_mask = "{}/data/search?term=GLDS&type={}&size={}&ffield={}&fvalue={}"
+    for ffield_alias, ffregex in ffield_kwargs.items():
+        field_accessions = set()
+        matches = get_ffield_matches(verbose=verbose, **{ffield_alias: ffregex})
+        for ffield, ffvalue in matches:
+            search_json = get_json(search_mask.format(
+                API_ROOT, datatype, maxcount, ffield, quote(ffvalue)
+            ))
+            try:
+                field_accessions |= {
+                    hit["_id"] for hit in search_json["hits"]["hits"]
+                }
+            except KeyError:
+                raise GeneLabJSONException("Malformed search JSON")
+        if accessions is None:
+            accessions = field_accessions
+        else:
+            accessions &= field_accessions
+    return sorted(accessions or [])
+
+
 def get_ffield_matches(verbose=False, **ffield_kwargs):
     """Expand passed regexes to all matching ffield values"""
     for ffield_alias, ffregex in ffield_kwargs.items():
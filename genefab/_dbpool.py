@@ -0,0 +1,149 @@
+from sqlite3 import connect, Connection
+from contextlib import contextmanager
+from threading import Lock
+from os import environ, getpid, stat
+
+
+SQLITE_POOL_MAXSIZE = int(
+    environ.get("GENEFAB_SQLITE_POOL_MAXSIZE", 32) # idle handles, all databases
+)
+SQLITE_BUSY_TIMEOUT = float(environ.get("GENEFAB_SQLITE_BUSY_TIMEOUT", 30))
+SQLITE_MMAP_SIZE = int(environ.get("GENEFAB_SQLITE_MMAP_SIZE", 256*1024*1024))
+SQLITE_CACHE_SIZE = int(
+    environ.get("GENEFAB_SQLITE_CACHE_SIZE", -16384) # negative: in KiB
+)
+SQLITE_SYNCHRONOUS = environ.get("GENEFAB_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_JOURNAL_SIZE_LIMIT = 64*1024*1024 # WAL is truncated to this after checkpoints
+SQLITE_CACHED_STATEMENTS = 256
+
+
+class PooledConnection(Connection):
+    """sqlite3 connection whose commits can be deferred to the end of a block"""
+    deferred = False
+
+    def commit(self):
+        """Commit, unless inside transaction(); pandas.to_sql() commits on its own"""
+        if not self.deferred:
+            super().commit()
+
+    @contextmanager
+    def transaction(self):
+        """Run block as one write transaction; readers see all of it or none of it"""
+        self.execute("BEGIN IMMEDIATE")
+        self.deferred = True
+        try:
+            yield self
+        except:
+            self.deferred = False
+            self.rollback()
+            raise
+        self.deferred = False
+        self.commit()
+
+
+class SQLitePool():
+    """Per-process pool of WAL-mode database handles, shared between threads one at a time"""
+    opened, reused, closed = 0, 0, 0
+
+    def __init__(self, maxsize=SQLITE_POOL_MAXSIZE, timeout=SQLITE_BUSY_TIMEOUT, mmap_size=SQLITE_MMAP_SIZE, cache_size=SQLITE_CACHE_SIZE, synchronous=SQLITE_SYNCHRONOUS):
+        """Store settings; handles are opened lazily per process"""
+        self.maxsize, self.timeout = maxsize, timeout
+        self.pragmas = [
+            "PRAGMA journal_mode=WAL", # readers do not block behind a writer
+            "PRAGMA synchronous={}".format(synchronous),
+            "PRAGMA mmap_size={}".format(int(mmap_size)),
+            "PRAGMA cache_size={}".format(int(cache_size)),
+            "PRAGMA journal_size_limit={}".format(SQLITE_JOURNAL_SIZE_LIMIT),
+        ]
+        self._idle = [] # (db_name, inode, handle), least recently used first
+        self._lock = Lock()
+        self._pid = None
+
+    def open(self, db_name):
+        """Open new handle with pragmas applied"""
+        db = connect(
+            db_name, timeout=self.timeout, factory=PooledConnection,
+            check_same_thread=False, cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        for pragma in self.pragmas:
+            db.execute(pragma).fetchall()
+        with self._lock:
+            self.opened += 1
+        return db
+
+    def checkout(self, db_name):
+        """Take idle handle to db_name (if the file has not been replaced) or open new one"""
+        try:
+            inode = stat(db_name).st_ino
+        except FileNotFoundError:
+            inode = None
+        with self._lock:
+            if self._pid != getpid(): # handles must not be used across fork
+                self._idle, self._pid = [], getpid()
+            for i in range(len(self._idle)-1, -1, -1):
+                if self._idle[i][0] == db_name:
+                    _, idle_inode, db = self._idle.pop(i)
+                    if idle_inode == inode:
+                        self.reused += 1
+                        return db
+                    else: # stale handle to a removed or replaced file
+                        self.closed += 1
+                        db.close()
+                        break
+        return self.open(db_name)
+
+    def checkin(self, db_name, db):
+        """Return handle to pool, closing least recently used ones above maxsize"""
+        db.deferred = False
+        if db.in_transaction:
+            db.rollback()
+        try:
+            inode = stat(db_name).st_ino
+        except FileNotFoundError:
+            self.discard(db)
+            return
+        with self._lock:
+            if self._pid != getpid():
+                return
+            self._idle.append((db_name, inode, db))
+            while len(self._idle) > self.maxsize:
+                _, _, stale_db = self._idle.pop(0)
+                self.closed += 1
+                stale_db.close()
+
+    @contextmanager
+    def connection(self, db_name):
+        """Handle for exclusive use within block"""
+        db = self.checkout(db_name)
+        try:
+            yield db
+        except:
+            self.discard(db) # may be left in an unknown state
+            raise
+        self.checkin(db_name, db)
+
+    def discard(self, db):
+        """Close handle instead of returning it to pool"""
+        with self._lock:
+            self.closed += 1
+        db.close()
+
+    def clear(self):
+        """Close all idle handles"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.closed += len(idle)
+        for _, _, db in idle:
+            db.close()
+
+    @property
+    def stats(self):
+        """Counters of opened, reused and closed handles"""
+        with self._lock:
+            return {
+                "idle": len(self._idle), "opened": self.opened,
+                "reused": self.reused, "closed": self.closed,
+            }
+
+
+SQLITE_POOL = SQLitePool()
@@ -1,11 +1,35 @@
 from flask import Response, request
 from json import JSONEncoder, dumps
-from pandas import DataFrame, option_context, Series
+from pandas import DataFrame, option_context, Series, concat
+from collections.abc import Iterator
+from itertools import chain
 from re import sub
 from traceback import format_tb
 from sys import exc_info
-from genefab._util import log
-from genefab._exceptions import GeneLabDataManagerException
+from zlib import compressobj, DEFLATED, MAX_WBITS
+from gzip import compress as gzip_compress, decompress as gzip_decompress
+from csv import writer
+from io import StringIO, BytesIO
+from numpy import rec
+from numpy.lib.format import write_array
+from zipfile import ZipFile, ZIP_STORED
+from hashlib import sha512
+from datetime import datetime, timezone
+from genefab._util import log, BINARY_FMT_MIMETYPES
+from genefab._metrics import METRICS
+from genefab._exceptions import GeneLabException, GeneLabDataManagerException
+
+try:
+    from pyarrow import Table, BufferOutputStream, ipc
+    from pyarrow.parquet import write_table
+except ImportError:
+    Table = None
+
+
+STREAMING_CHUNK_ROWS = 4096
+GZIP_COMPRESS_LEVEL = 6
+GCT_VERSION = "#1.2"
+CACHED_HEADERS = {"X-Total-Count", "X-Next-Cursor"}
 
 
 def traceback_printer(e):
@@ -54,14 +78,19 @@ def to_dataframe(obj):
         return DataFrame(columns=["value"], data=obj)
 
 
-def fix_cols(repr_df, cols_to_fix={"Unnamed: 0": "Sample Name"}):
-    """Fix columns arising from different conventions in CSVs (unnamed column instead of 'Sample Name')"""
+def get_cols_renamer(columns, cols_to_fix={"Unnamed: 0": "Sample Name"}):
+    """Map columns arising from different conventions in CSVs to their fixed names"""
     renamer = {}
-    for bad_col in repr_df.columns:
+    for bad_col in columns:
         if bad_col in cols_to_fix:
-            if cols_to_fix[bad_col] not in repr_df.columns:
+            if cols_to_fix[bad_col] not in columns:
                 renamer[bad_col] = cols_to_fix[bad_col]
-    return repr_df.rename(columns=renamer)
+    return renamer
+
+
+def fix_cols(repr_df, cols_to_fix={"Unnamed: 0": "Sample Name"}):
+    """Fix columns arising from different conventions in CSVs (unnamed column instead of 'Sample Name')"""
+    return repr_df.rename(columns=get_cols_renamer(repr_df.columns, cols_to_fix))
 
 
 def show_or_hide_cols(repr_df, show=None, hide=None):
@@ -85,6 +114,202 @@ def show_or_hide_cols(repr_df, show=None, hide=None):
     return repr_df[columns_passed]
 
 
+def iterate_row_chunks(obj, chunk_rows=STREAMING_CHUNK_ROWS):
+    """Split dataframe into views of consecutive rows"""
+    for start in range(0, obj.shape[0], chunk_rows):
+        yield obj.iloc[start:start+chunk_rows]
+
+
+def stream_tsv(chunks, index):
+    """Render TSV chunk by chunk; output is identical to a single to_csv()"""
+    for i, chunk in enumerate(chunks):
+        yield chunk.to_csv(sep="\t", index=index, na_rep="NA", header=(i==0))
+
+
+def stream_json(chunks, index, orient):
+    """Render JSON chunk by chunk by splicing per-chunk objects/arrays"""
+    opener, closer = ("{", "}") if orient == "index" else ("[", "]")
+    yield opener
+    for i, chunk in enumerate(chunks):
+        chunk_repr = chunk.to_json(index=index, orient=orient)[1:-1]
+        if chunk_repr:
+            yield ("," if i else "") + chunk_repr
+    yield closer
+
+
+def gzip_stream(chunks, compresslevel=GZIP_COMPRESS_LEVEL):
+    """Compress text chunks on the fly into a single gzip member"""
+    compressor = compressobj(compresslevel, DEFLATED, MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def is_gzip_accepted():
+    """Check if client accepts gzip-encoded bodies (with nonzero quality)"""
+    return request.accept_encodings["gzip"] > 0
+
+
+def streaming_response(chunks, mimetype):
+    """Generator-backed Response; compressed here because streams bypass flask_compress"""
+    if is_gzip_accepted():
+        response = Response(gzip_stream(chunks), mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(chunks, mimetype=mimetype)
+    response.vary.add("Accept-Encoding") # either way, caches must tell them apart
+    return response
+
+
+def to_numpy_columns(obj, index):
+    """Named arrays of columns (and index); text is converted so that no pickling is needed"""
+    named_arrays = [(str(c), obj[c].values) for c in obj.columns]
+    if index:
+        named_arrays.insert(0, (str(obj.index.name or "index"), obj.index.values))
+    if len({name for name, _ in named_arrays}) != len(named_arrays):
+        raise ValueError("npy and npz formats require unique column names")
+    return [
+        (name, array.astype(str) if array.dtype.kind == "O" else array)
+        for name, array in named_arrays
+    ]
+
+
+def render_binary(obj, fmt, index):
+    """Serialize dataframe to bytes of a binary format"""
+    if fmt in {"arrow", "parquet"}:
+        if Table is None:
+            raise NotImplementedError("fmt={} requires pyarrow".format(fmt))
+        # like the table store, keep the index so that pandas round-trips it:
+        table = Table.from_pandas(obj, preserve_index=True)
+        sink = BufferOutputStream()
+        if fmt == "arrow":
+            with ipc.new_stream(sink, table.schema) as stream_writer:
+                stream_writer.write_table(table)
+        else:
+            write_table(table, sink)
+        return sink.getvalue().to_pybytes()
+    named_arrays = to_numpy_columns(obj, index)
+    buffer = BytesIO()
+    if fmt == "npy": # structured array, one field per column
+        if not named_arrays:
+            raise ValueError("nothing to convert to npy")
+        write_array(buffer, rec.fromarrays(
+            [array for _, array in named_arrays],
+            names=[name for name, _ in named_arrays]
+        ), allow_pickle=False)
+    elif fmt == "npz": # one array per column, same layout as numpy.savez()
+        with ZipFile(buffer, mode="w", compression=ZIP_STORED) as archive:
+            for name, array in named_arrays:
+                with archive.open(name + ".npy", mode="w", force_zip64=True) as npy:
+                    write_array(npy, array, allow_pickle=False)
+    else:
+        raise ValueError("Unknown binary format: '{}'".format(fmt))
+    return buffer.getvalue()
+
+
+def get_etag(*parts):
+    """Validator derived from everything that determines the response body"""
+    return sha512(
+        dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:32]
+
+
+def get_last_modified(date):
+    """Timezone-aware datetime of a file date stamp; None if unknown"""
+    if (date is None) or (date < 0):
+        return None
+    else:
+        return datetime.fromtimestamp(date, timezone.utc)
+
+
+def set_validators(response, etag, date):
+    """Add ETag (weak, as gzipped and plain bodies share it) and Last-Modified to a successful response"""
+    if isinstance(response, Response) and (response.status_code in {200, 304}):
+        response.set_etag(etag, weak=True)
+        last_modified = get_last_modified(date)
+        if last_modified is not None:
+            response.last_modified = last_modified
+    return response
+
+
+def check_not_modified(etag, date):
+    """Empty 304 response if the client's copy is current, otherwise None"""
+    if request.if_none_match: # takes precedence over If-Modified-Since
+        is_current = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None:
+        last_modified = get_last_modified(date)
+        if_modified_since = request.if_modified_since
+        if if_modified_since.tzinfo is None: # older werkzeug; value is in UTC
+            if_modified_since = if_modified_since.replace(tzinfo=timezone.utc)
+        is_current = (last_modified is not None) and (
+            last_modified <= if_modified_since
+        )
+    else:
+        is_current = False
+    if is_current:
+        return set_validators(Response(status=304), etag, date)
+    else:
+        return None
+
+
+def capture_response(response, store, maxbytes):
+    """Pass response through; `store(body, is_gzipped, mimetype, headers)` once the body is complete"""
+    if (not isinstance(response, Response)) or (response.status_code != 200):
+        return response
+    mimetype = response.mimetype
+    headers = {
+        key: value for key, value in response.headers.items()
+        if key in CACHED_HEADERS
+    }
+    is_gzipped = (response.headers.get("Content-Encoding") == "gzip")
+    def store_body(body):
+        if mimetype.startswith("text/") and (not is_gzipped):
+            store(gzip_compress(body, GZIP_COMPRESS_LEVEL), True, mimetype, headers)
+        else:
+            store(body, is_gzipped, mimetype, headers)
+    if response.is_streamed:
+        encoded_chunks = response.iter_encoded()
+        def iterator():
+            captured, captured_size = [], 0
+            for chunk in encoded_chunks:
+                if captured is not None:
+                    captured_size += len(chunk)
+                    if captured_size > maxbytes:
+                        captured = None
+                    else:
+                        captured.append(chunk)
+                yield chunk
+            if captured is not None: # i.e., not too large, and sent completely
+                store_body(b"".join(captured))
+        response.response = iterator()
+    else:
+        body = response.get_data()
+        if len(body) <= maxbytes:
+            store_body(body)
+    return response
+
+
+def rendered_response(rendered):
+    """Response from a cached rendered body; decompressed for clients that do not accept gzip"""
+    if rendered.is_gzipped and is_gzip_accepted():
+        response = Response(rendered.body, mimetype=rendered.mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    elif rendered.is_gzipped:
+        response = Response(
+            gzip_decompress(rendered.body), mimetype=rendered.mimetype
+        )
+    else:
+        response = Response(rendered.body, mimetype=rendered.mimetype)
+    if rendered.is_gzipped:
+        response.vary.add("Accept-Encoding")
+    for key, value in rendered.headers.items():
+        response.headers[key] = value
+    return response
+
+
+@METRICS.timed("display_dataframe")
 def display_dataframe(obj, display_rargs, index, cols_to_fix={"Unnamed: 0": "Sample Name"}):
     """Select appropriate converter and mimetype for fmt with DataFrame"""
     if cols_to_fix:
@@ -105,13 +330,34 @@ def display_dataframe(obj, display_rargs, index, cols_to_fix={"Unnamed: 0": "Sam
             raise ValueError("`top` must be a positive integer")
     if display_rargs["header"]:
         obj = DataFrame(columns=obj.columns, index=["header"])
+    if display_rargs["fmt"] in BINARY_FMT_MIMETYPES:
+        return Response(
+            render_binary(obj, display_rargs["fmt"], index),
+            mimetype=BINARY_FMT_MIMETYPES[display_rargs["fmt"]]
+        )
+    is_streamable = (
+        (obj.shape[0] > STREAMING_CHUNK_ROWS) and obj.columns.is_unique
+    )
     if display_rargs["fmt"] == "tsv":
+        if is_streamable:
+            return streaming_response(
+                stream_tsv(iterate_row_chunks(obj), index=index),
+                mimetype="text/plain"
+            )
         obj_repr = obj.to_csv(sep="\t", index=index, na_rep="NA")
         return Response(obj_repr, mimetype="text/plain")
     elif display_rargs["fmt"] == "html":
         with option_context("display.max_colwidth", -1):
             return obj.to_html(index=index, na_rep="NA", justify="left")
     elif display_rargs["fmt"] == "json":
+        if is_streamable and (index is True):
+            return streaming_response(
+                stream_json(
+                    iterate_row_chunks(obj), index=index,
+                    orient="index" if obj.index.is_unique else "records"
+                ),
+                mimetype="text/json"
+            )
         try:
             obj_repr = obj.to_json(index=index, orient="index")
             return Response(obj_repr, mimetype="text/json")
@@ -122,6 +368,62 @@ def display_dataframe(obj, display_rargs, index, cols_to_fix={"Unnamed: 0": "Sam
         raise ValueError("wrong extension or type?")
 
 
+def limit_row_chunks(chunks, limit):
+    """Pass chunks until `limit` rows have been passed"""
+    for chunk in chunks:
+        if chunk.shape[0] >= limit:
+            yield chunk.iloc[:limit]
+            return
+        else:
+            limit -= chunk.shape[0]
+            yield chunk
+
+
+def display_dataframe_chunks(chunks, display_rargs, index, cols_to_fix={"Unnamed: 0": "Sample Name"}):
+    """Same output as display_dataframe(concat(chunks)), streamed where possible"""
+    if display_rargs["fmt"] not in {"tsv", "json"}:
+        return display_dataframe(
+            concat(list(chunks)), display_rargs, index, cols_to_fix
+        )
+    chunks = (
+        show_or_hide_cols(
+            fix_cols(chunk, cols_to_fix) if cols_to_fix else chunk,
+            show=display_rargs["showcol"], hide=display_rargs["hidecol"]
+        )
+        for chunk in chunks
+    )
+    if display_rargs["top"] is not None:
+        if display_rargs["top"].isdigit() and int(display_rargs["top"]):
+            chunks = limit_row_chunks(chunks, int(display_rargs["top"]))
+        else:
+            raise ValueError("`top` must be a positive integer")
+    first_chunk = next(chunks, None) # errors surface before streaming starts
+    if first_chunk is None:
+        return display_dataframe(DataFrame(), display_rargs, index)
+    if display_rargs["header"]:
+        return display_dataframe(
+            first_chunk, display_rargs, index, cols_to_fix=None
+        )
+    chunks = chain([first_chunk], chunks)
+    if not first_chunk.columns.is_unique:
+        return display_dataframe(
+            concat(list(chunks)), display_rargs, index, cols_to_fix=None
+        )
+    elif display_rargs["fmt"] == "tsv":
+        return streaming_response(
+            stream_tsv(chunks, index=index), mimetype="text/plain"
+        )
+    elif index is True: # chunks are expected to have a unique index overall
+        return streaming_response(
+            stream_json(chunks, index=index, orient="index"),
+            mimetype="text/json"
+        )
+    else:
+        return display_dataframe(
+            concat(list(chunks)), display_rargs, index, cols_to_fix=None
+        )
+
+
 def display_object(obj, display_rargs, index="auto", cols_to_fix={"Unnamed: 0": "Sample Name"}):
     """Select appropriate converter and mimetype for fmt"""
     if isinstance(obj, (dict, tuple, list)):
@@ -135,6 +437,10 @@ def display_object(obj, display_rargs, index="auto", cols_to_fix={"Unnamed: 0":
         return display_dataframe(
             obj, display_rargs, index=index, cols_to_fix=cols_to_fix
         )
+    elif isinstance(obj, Iterator): # of DataFrame chunks
+        return display_dataframe_chunks(
+            obj, display_rargs, index=index, cols_to_fix=cols_to_fix
+        )
     elif display_rargs["fmt"] == "raw":
         return Response(obj, mimetype="application")
     else:
@@ -143,6 +449,40 @@ def display_object(obj, display_rargs, index="auto", cols_to_fix={"Unnamed: 0":
         )
 
 
+def get_gct_columns(columns, samples):
+    """Non-sample columns in table order, then samples in annotation order"""
+    present, sample_set = set(columns), set(samples)
+    if sample_set - present:
+        raise GeneLabException(
+            "Sample names are present in the annotation but not in the GCT",
+            sorted(sample_set - present)
+        )
+    return (
+        [c for c in columns if c not in sample_set] +
+        [c for c in samples if c in present]
+    )
+
+
+def stream_gct(obj, samples, chunk_rows=STREAMING_CHUNK_ROWS):
+    """Render table as GCT chunk by chunk; columns are picked per chunk, not copied up front"""
+    columns = get_gct_columns(obj.columns, samples)
+    # first column doubles as 'Name' and 'Description':
+    chunk_columns = columns[:1] + columns
+    header = StringIO()
+    writer(header, delimiter="\t", lineterminator="\n").writerow(
+        ["Name", "Description"] + columns[1:]
+    )
+    def iterator():
+        yield "{}\n{}\t{}\n{}".format(
+            GCT_VERSION, obj.shape[0], len(columns)-1, header.getvalue()
+        )
+        for chunk in iterate_row_chunks(obj, chunk_rows):
+            yield chunk.to_csv(
+                sep="\t", index=False, header=False, columns=chunk_columns
+            )
+    return iterator()
+
+
 def to_cls(dataframe, target, continuous="infer", space_sub=lambda s: sub(r'\s', "", s)):
     """Convert a presumed annotation/factor dataframe to CLS format"""
     sample_count = dataframe.shape[0]
@@ -0,0 +1,134 @@
+from os import environ
+from threading import Lock
+from contextvars import ContextVar
+from functools import wraps
+from bisect import bisect_left
+from time import perf_counter
+
+
+METRICS_ENABLED = environ.get("GENEFAB_METRICS", "0") != "0"
+LATENCY_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+)
+REQUEST_TIMINGS = ContextVar("genefab_request_timings", default=None)
+
+
+class Metrics():
+    """Process-level per-stage latency histograms and byte counters; inert unless enabled"""
+
+    def __init__(self, enabled=METRICS_ENABLED, buckets=LATENCY_BUCKETS):
+        """Initialize empty histograms and counters"""
+        self.enabled, self.buckets = enabled, buckets
+        self._histograms = {} # stage -> (counts per bucket and +Inf, sum)
+        self._counters = {}
+        self._lock = Lock()
+
+    def timed(self, stage):
+        """Decorator recording the duration of each call; leaves function as is when disabled"""
+        def decorator(f):
+            if not self.enabled:
+                return f
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(stage, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds):
+        """Add duration to stage histogram and to the timings of the current request"""
+        with self._lock:
+            counts, total = self._histograms.get(stage, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect_left(self.buckets, seconds)] += 1
+            self._histograms[stage] = counts, total + seconds
+            timings = REQUEST_TIMINGS.get() # shared with fetcher threads
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0) + seconds
+
+    def count(self, counter, value=1):
+        """Increment counter"""
+        if self.enabled:
+            with self._lock:
+                self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def start_request(self):
+        """Start collecting stage timings of the request handled in this context"""
+        REQUEST_TIMINGS.set({})
+        return perf_counter()
+
+    def server_timing(self, start):
+        """Value of Server-Timing header: time per stage so far, and in total, in ms"""
+        timings = REQUEST_TIMINGS.get() or {}
+        return ", ".join(
+            "{};dur={:.1f}".format(stage, seconds * 1000)
+            for stage, seconds in list(timings.items()) + [
+                ("total", perf_counter() - start)
+            ]
+        )
+
+    def counted(self, chunks, counter="served_bytes", stage="stream"):
+        """Pass through chunks of a streamed body, counting bytes and time until exhausted"""
+        start, nbytes = perf_counter(), 0
+        try:
+            for chunk in chunks:
+                nbytes += len(chunk)
+                yield chunk
+        finally:
+            self.count(counter, nbytes)
+            self.observe(stage, perf_counter() - start)
+
+    def render(self, cache_stats=()):
+        """Prometheus text exposition of histograms, counters and cache counters"""
+        with self._lock:
+            histograms = {
+                stage: (list(counts), total)
+                for stage, (counts, total) in self._histograms.items()
+            }
+            counters = dict(self._counters)
+        lines = ["# TYPE genefab_stage_seconds histogram"]
+        for stage, (counts, total) in sorted(histograms.items()):
+            cumulative = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append(
+                    'genefab_stage_seconds_bucket{{stage="{}",le="{}"}} {}'
+                    .format(stage, le, cumulative)
+                )
+            lines.append(
+                'genefab_stage_seconds_sum{{stage="{}"}} {}'.format(stage, total)
+            )
+            lines.append(
+                'genefab_stage_seconds_count{{stage="{}"}} {}'.format(
+                    stage, cumulative
+                )
+            )
+        for counter, value in sorted(counters.items()):
+            lines.append("# TYPE genefab_{}_total counter".format(counter))
+            lines.append("genefab_{}_total {}".format(counter, value))
+        lines.append("# TYPE genefab_cache gauge")
+        hit_ratios = []
+        for cache_name, stats in cache_stats:
+            for counter, value in stats.items():
+                if isinstance(value, (int, float)):
+                    lines.append(
+                        'genefab_cache{{cache="{}",counter="{}"}} {}'.format(
+                            cache_name, counter, float(value)
+                        )
+                    )
+            hits, misses = stats.get("hits"), stats.get("misses")
+            if (hits is not None) and (misses is not None) and (hits + misses):
+                hit_ratios.append((cache_name, hits / (hits + misses)))
+        lines.append("# TYPE genefab_cache_hit_ratio gauge")
+        for cache_name, ratio in hit_ratios:
+            lines.append(
+                'genefab_cache_hit_ratio{{cache="{}"}} {}'.format(cache_name, ratio)
+            )
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
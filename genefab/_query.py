@@ -0,0 +1,735 @@
+from re import sub, search, IGNORECASE
+from math import isnan
+from json import dumps, loads
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from hashlib import sha512
+from numpy import full, arange, flatnonzero, concatenate, zeros, ones
+from numpy import partition, sort
+from pandas import isnull
+from operator import __lt__, __le__, __eq__, __ne__, __ge__, __gt__
+
+
+OPERATOR_MAPPER = {
+    "<": __lt__, "<=": __le__, ">=": __ge__, ">": __gt__,
+    "==": __eq__, "!=": __ne__
+}
+FLIPPED_OPERATORS = {
+    "<": ">", "<=": ">=", ">=": "<=", ">": "<", "==": "==", "!=": "!="
+}
+SQL_NUMERIC_TYPES = {"REAL", "INTEGER", "FLOAT", "DOUBLE", "NUMERIC"}
+FILTER_KEYWORDS = {"and", "or", "not", "in"}
+FILTER_SYMBOLS = [ # longest first
+    ("<=", "op"), (">=", "op"), ("==", "op"), ("!=", "op"),
+    ("&&", "and"), ("||", "or"), ("<", "op"), (">", "op"),
+    ("&", "and"), ("|", "or"), ("!", "not"),
+    ("(", "("), (")", ")"), (",", ","),
+]
+FILTER_WORD_BREAKS = set("<>=!&|(),'\"`") # and whitespace
+FILTER_COLUMN_BOUNDARY = set("<>=!&|),") # and whitespace
+
+
+def parse_field_filter(field_filter):
+    """Split a single `filter` request argument into field, comparison, value"""
+    field_filter_stripped = sub(r'(^\')|(\'$)', "", field_filter)
+    match = search(r'(^.+?)([<>=!]+)(.+)$', field_filter_stripped)
+    if not match:
+        raise ValueError("Malformed `filter`")
+    field, comparison, value = match.groups()
+    if comparison not in OPERATOR_MAPPER:
+        error_mask = "Bad comparison: '{}'"
+        raise ValueError(error_mask.format(comparison))
+    return field, comparison, interpret_word(value)
+
+
+def interpret_word(word):
+    """Convert unquoted value to float or boolean if possible"""
+    try:
+        return float(word)
+    except ValueError:
+        if word == "True":
+            return True
+        elif word == "False":
+            return False
+        else:
+            return word
+
+
+def compare_values(values, comparison, value):
+    """Compare numpy array to scalar; nulls in object arrays compare like in pandas"""
+    compare = OPERATOR_MAPPER[comparison]
+    if values.dtype == object:
+        notnull = ~isnull(values)
+        indexer = full(len(values), comparison == "!=")
+        indexer[notnull] = compare(values[notnull], value)
+        return indexer
+    elif isinstance(value, str):
+        if comparison == "==":
+            return zeros(len(values), dtype=bool)
+        elif comparison == "!=":
+            return ones(len(values), dtype=bool)
+        else:
+            raise TypeError("cannot order {} and str".format(values.dtype))
+    else:
+        return compare(values, value)
+
+
+def compare_arrays(left, comparison, right):
+    """Compare two numpy arrays elementwise; pairs with nulls compare like in pandas"""
+    compare = OPERATOR_MAPPER[comparison]
+    if (left.dtype == object) or (right.dtype == object):
+        notnull = ~(isnull(left) | isnull(right))
+        indexer = full(len(left), comparison == "!=")
+        indexer[notnull] = compare(
+            left[notnull].astype(object), right[notnull].astype(object)
+        )
+        return indexer
+    else:
+        return compare(left, right)
+
+
+def stable_argsort(values, ascending=True):
+    """Replicate stable `sort_values`: ties keep order, nulls go last"""
+    nulls = isnull(values)
+    positions = arange(len(values))
+    non_null_positions = positions[~nulls]
+    if ascending:
+        order = values[~nulls].argsort(kind="mergesort")
+        sorted_positions = non_null_positions[order]
+    else:
+        order = values[~nulls][::-1].argsort(kind="mergesort")
+        sorted_positions = non_null_positions[::-1][order][::-1]
+    return concatenate([sorted_positions, positions[nulls]])
+
+
+def stable_top_k(values, k, ascending=True):
+    """Same as stable_argsort(values, ascending)[:k], but only sorts k values"""
+    non_null_positions = flatnonzero(~isnull(values))
+    n_non_null = len(non_null_positions)
+    if k <= 0:
+        return non_null_positions[:0]
+    elif k >= n_non_null:
+        return stable_argsort(values, ascending)[:k]
+    non_null_values = values[non_null_positions]
+    kth = k - 1 if ascending else n_non_null - k
+    threshold = partition(non_null_values, kth)[kth]
+    if ascending:
+        beyond = flatnonzero(non_null_values < threshold)
+    else:
+        beyond = flatnonzero(non_null_values > threshold)
+    # ties at threshold are taken in original order, like in a stable sort:
+    at = flatnonzero(non_null_values == threshold)[:k-len(beyond)]
+    selected = sort(concatenate([beyond, at]))
+    order = stable_argsort(non_null_values[selected], ascending)
+    return non_null_positions[selected[order]]
+
+
+def quote_sql_name(name):
+    """Quote column name for SQL"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def is_sql_compatible(column_type, value):
+    """Check if literal can be compared to column of this SQL type like in numpy"""
+    column_type = column_type.upper()
+    if isinstance(value, bool):
+        return False
+    elif isinstance(value, float):
+        return (not isnan(value)) and (column_type in SQL_NUMERIC_TYPES)
+    else:
+        return column_type == "TEXT"
+
+
+class Column():
+    """Column reference in filter expression"""
+
+    def __init__(self, name):
+        """Store column name"""
+        self.name = name
+
+    def evaluate(self, get_column):
+        """Column values as numpy array"""
+        return get_column(self.name)
+
+
+class Literal():
+    """Scalar value in filter expression; `word` is the unquoted source, if any"""
+
+    def __init__(self, value, word=None):
+        """Store value"""
+        self.value, self.word = value, word
+
+    def evaluate(self, get_column):
+        """Scalar value"""
+        return self.value
+
+
+class Comparison():
+    """Comparison of column to value, or of two columns"""
+
+    def __init__(self, left, comparison, right):
+        """Store operands and comparison operator"""
+        self.left, self.comparison, self.right = left, comparison, right
+
+    def evaluate(self, get_column):
+        """Boolean numpy array"""
+        left, right = self.left, self.right
+        comparison = self.comparison
+        if isinstance(left, Literal):
+            left, right = right, left
+            comparison = FLIPPED_OPERATORS[comparison]
+        values = left.evaluate(get_column)
+        try:
+            if isinstance(right, Column):
+                return compare_arrays(
+                    values, comparison, right.evaluate(get_column)
+                )
+            else:
+                return compare_values(values, comparison, right.value)
+        except TypeError:
+            emsk = "Invalid comparison (TypeError): '{}' is `{}` and {} is `{}`"
+            if isinstance(right, Column):
+                right_repr = "'{}'".format(right.name)
+                right_type = get_column(right.name).dtype
+            else:
+                right_repr, right_type = right.value, type(right.value).__name__
+            raise TypeError(emsk.format(
+                left.name, values.dtype, right_repr, right_type
+            ))
+
+    def to_sql(self, column_types):
+        """SQL condition (never NULL) and parameters; None if types differ"""
+        left, right = self.left, self.right
+        if isinstance(left, Literal):
+            left, right = right, left
+        left_type = column_types[left.name].upper()
+        if isinstance(right, Column):
+            right_type = column_types[right.name].upper()
+            both_numeric = (left_type in SQL_NUMERIC_TYPES) and (
+                right_type in SQL_NUMERIC_TYPES
+            )
+            if not (both_numeric or (left_type == right_type == "TEXT")):
+                return None
+            params = []
+        elif not is_sql_compatible(left_type, right.value):
+            return None
+        else:
+            params = [right.value]
+        operands = [
+            quote_sql_name(operand.name) if isinstance(operand, Column)
+            else "?" for operand in (self.left, self.right)
+        ]
+        condition = "COALESCE({} {} {}, {})".format(
+            operands[0], "=" if self.comparison == "==" else self.comparison,
+            operands[1], 1 if self.comparison == "!=" else 0
+        )
+        return condition, params
+
+
+class Membership():
+    """Check if column value is (or is not) one of literals"""
+
+    def __init__(self, column, values, negate=False):
+        """Store column and literals"""
+        self.column, self.values, self.negate = column, values, negate
+
+    def evaluate(self, get_column):
+        """Boolean numpy array; same as OR of `==` comparisons"""
+        values = self.column.evaluate(get_column)
+        indexer = zeros(len(values), dtype=bool)
+        for literal in self.values:
+            indexer |= compare_values(values, "==", literal.value)
+        return ~indexer if self.negate else indexer
+
+    def to_sql(self, column_types):
+        """SQL condition (never NULL) and parameters; None if types differ"""
+        column_type = column_types[self.column.name]
+        params = [literal.value for literal in self.values]
+        if not all(is_sql_compatible(column_type, p) for p in params):
+            return None
+        condition = "COALESCE({} IN ({}), 0)".format(
+            quote_sql_name(self.column.name), ", ".join("?" for _ in params)
+        )
+        if self.negate:
+            condition = "NOT " + condition
+        return condition, params
+
+
+class Conjunction():
+    """Logical AND / OR of subexpressions"""
+
+    def __init__(self, operator, operands):
+        """Store operator ('and' or 'or') and subexpressions"""
+        self.operator, self.operands = operator, operands
+
+    def evaluate(self, get_column):
+        """Boolean numpy array"""
+        indexer = None
+        for operand in self.operands:
+            operand_indexer = operand.evaluate(get_column)
+            if indexer is None:
+                indexer = operand_indexer.copy()
+            elif self.operator == "and":
+                indexer &= operand_indexer
+            else:
+                indexer |= operand_indexer
+        return indexer
+
+    def to_sql(self, column_types):
+        """SQL condition and parameters; None if any operand cannot be compiled"""
+        conditions, params = [], []
+        for operand in self.operands:
+            compiled = operand.to_sql(column_types)
+            if compiled is None:
+                return None
+            conditions.append(compiled[0])
+            params.extend(compiled[1])
+        joiner = " {} ".format(self.operator.upper())
+        return "(" + joiner.join(conditions) + ")", params
+
+
+class Negation():
+    """Logical NOT of subexpression"""
+
+    def __init__(self, operand):
+        """Store subexpression"""
+        self.operand = operand
+
+    def evaluate(self, get_column):
+        """Boolean numpy array"""
+        return ~self.operand.evaluate(get_column)
+
+    def to_sql(self, column_types):
+        """SQL condition and parameters; None if operand cannot be compiled"""
+        compiled = self.operand.to_sql(column_types)
+        if compiled is None:
+            return None
+        return "(NOT {})".format(compiled[0]), compiled[1]
+
+
+def tokenize_filter(text, columns):
+    """Split filter expression into tokens; known column names take precedence"""
+    columns_by_length = sorted(columns, key=len, reverse=True)
+    tokens, i = [], 0
+    while i < len(text):
+        if text[i].isspace():
+            i += 1
+            continue
+        for column in columns_by_length:
+            end = i + len(column)
+            if text.startswith(column, i) and (
+                    (end == len(text)) or text[end].isspace() or
+                    (text[end] in FILTER_COLUMN_BOUNDARY)):
+                tokens.append(("column", column))
+                i = end
+                break
+        else:
+            if text[i] in "`'\"":
+                end = text.find(text[i], i+1)
+                if end == -1:
+                    raise ValueError("Unterminated quote in `filter`")
+                kind = "column" if text[i] == "`" else "literal"
+                tokens.append((kind, text[i+1:end]))
+                i = end + 1
+                continue
+            for symbol, kind in FILTER_SYMBOLS:
+                if text.startswith(symbol, i):
+                    tokens.append((kind, symbol))
+                    i += len(symbol)
+                    break
+            else:
+                end = i
+                while (end < len(text)) and not (
+                        text[end].isspace() or
+                        (text[end] in FILTER_WORD_BREAKS)):
+                    end += 1
+                if end == i:
+                    raise ValueError(
+                        "Malformed `filter`: unexpected '{}'".format(text[i])
+                    )
+                word = text[i:end]
+                if word.lower() in FILTER_KEYWORDS:
+                    tokens.append((word.lower(), word))
+                else:
+                    tokens.append(("word", word))
+                i = end
+    return tokens
+
+
+class FilterParser():
+    """Recursive descent parser of filter expressions:
+    expression := term ("or" term)*; term := factor ("and" factor)*;
+    factor := "not" factor | "(" expression ")" | comparison;
+    comparison := operand (op operand)+ | column ["not"] "in" "(" values ")"
+    """
+
+    def __init__(self, text, columns):
+        """Tokenize text"""
+        self.tokens = tokenize_filter(text, columns)
+        self.columns = set(columns)
+        self.position = 0
+
+    def peek(self, offset=0):
+        """Kind of upcoming token"""
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset][0]
+        else:
+            return None
+
+    def take(self, kind=None):
+        """Consume token, optionally requiring its kind"""
+        if self.peek() is None:
+            raise ValueError("Malformed `filter`: unexpected end")
+        elif (kind is not None) and (self.peek() != kind):
+            raise ValueError("Malformed `filter`: expected '{}'".format(kind))
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        """Parse whole text"""
+        expression = self.expression()
+        if self.peek() is not None:
+            raise ValueError("Malformed `filter`: unexpected '{}'".format(
+                self.tokens[self.position][1]
+            ))
+        return expression
+
+    def expression(self):
+        """Parse OR of terms"""
+        operands = [self.term()]
+        while self.peek() == "or":
+            self.take()
+            operands.append(self.term())
+        return operands[0] if len(operands) == 1 else Conjunction("or", operands)
+
+    def term(self):
+        """Parse AND of factors"""
+        operands = [self.factor()]
+        while self.peek() == "and":
+            self.take()
+            operands.append(self.factor())
+        return operands[0] if len(operands) == 1 else Conjunction("and", operands)
+
+    def factor(self):
+        """Parse negation, parenthesized expression or comparison"""
+        if self.peek() == "not":
+            self.take()
+            return Negation(self.factor())
+        elif self.peek() == "(":
+            self.take()
+            expression = self.expression()
+            self.take(")")
+            return expression
+        else:
+            return self.comparison()
+
+    def operand(self):
+        """Parse column or value"""
+        if self.peek() not in {"column", "literal", "word"}:
+            raise ValueError("Malformed `filter`: expected field or value")
+        kind, value = self.take()
+        if kind == "column":
+            if value not in self.columns:
+                raise ValueError("Unknown field (column): '{}'".format(value))
+            return Column(value)
+        elif kind == "literal":
+            return Literal(value)
+        else:
+            return Literal(interpret_word(value), word=value)
+
+    def comparison(self):
+        """Parse (chained) comparison or membership test"""
+        operands, comparisons = [self.operand()], []
+        if (self.peek() == "in") or (
+                (self.peek() == "not") and (self.peek(1) == "in")):
+            negate = (self.take()[0] == "not")
+            if negate:
+                self.take("in")
+            self.take("(")
+            values = [self.operand()]
+            while self.peek() == ",":
+                self.take()
+                values.append(self.operand())
+            self.take(")")
+            self.require_column(operands[:1])
+            if any(isinstance(v, Column) for v in values):
+                raise ValueError("Malformed `filter`: 'in' takes values only")
+            return Membership(operands[0], values, negate)
+        while self.peek() == "op":
+            comparisons.append(self.take()[1])
+            operands.append(self.operand())
+        if not comparisons:
+            raise ValueError("Malformed `filter`: expected comparison")
+        chain = []
+        for left, comparison, right in zip(operands, comparisons, operands[1:]):
+            self.require_column([left, right])
+            chain.append(Comparison(left, comparison, right))
+        return chain[0] if len(chain) == 1 else Conjunction("and", chain)
+
+    def require_column(self, operands):
+        """Fail if none of the operands refers to a column"""
+        if any(isinstance(operand, Column) for operand in operands):
+            return
+        for operand in operands:
+            if (operand.word is not None) and isinstance(operand.value, str):
+                raise ValueError("Unknown field (column): '{}'".format(
+                    operand.word
+                ))
+        raise ValueError("Malformed `filter`: no field (column) in comparison")
+
+
+def parse_filter(text, columns):
+    """Parse one `filter` argument into expression tree; fall back to legacy syntax"""
+    columns = [column for column in columns if isinstance(column, str)]
+    try:
+        return FilterParser(text, columns).parse()
+    except ValueError as e:
+        error = e
+    stripped = sub(r'(^\')|(\'$)', "", text)
+    if stripped != text:
+        try:
+            return FilterParser(stripped, columns).parse()
+        except ValueError:
+            pass
+    try: # 'column_name<value', where value may contain spaces etc
+        field, comparison, value = parse_field_filter(text)
+    except ValueError:
+        raise error
+    if field not in columns:
+        raise ValueError("Unknown field (column): '{}'".format(field))
+    return Comparison(Column(field), comparison, Literal(value))
+
+
+def parse_filters(field_filters_raw, columns):
+    """Parse one or multiple `filter` arguments, combined with AND"""
+    if field_filters_raw is None:
+        return None
+    elif not isinstance(field_filters_raw, (list, tuple, set)):
+        field_filters = [field_filters_raw]
+    else:
+        field_filters = list(field_filters_raw)
+    expressions = [parse_filter(ff, columns) for ff in field_filters]
+    if len(expressions) == 0:
+        return None
+    elif len(expressions) == 1:
+        return expressions[0]
+    else:
+        return Conjunction("and", expressions)
+
+
+def any_below_expression(columns, any_below):
+    """Expression passing rows where at least one adjusted p-value is below cutoff"""
+    cutoff = float(any_below)
+    filterable_fields = [
+        field for field in columns
+        if isinstance(field, str) and search(r'^adj-p-value', field, IGNORECASE)
+    ]
+    if not filterable_fields:
+        raise ValueError("`any_below` requires adjusted p-value columns")
+    return Conjunction("or", [
+        Comparison(Column(field), "<", Literal(cutoff))
+        for field in filterable_fields
+    ])
+
+
+def get_frame_column_getter(dataframe):
+    """Column getter for expression evaluation over a pandas DataFrame"""
+    def get_column(name):
+        values = dataframe[name].values
+        if values.ndim != 1:
+            raise ValueError("Ambiguous field (column): '{}'".format(name))
+        return values
+    return get_column
+
+
+class TableQuery():
+    """Row filters, sorting, row limit and page that may be evaluated by the table store"""
+    filters, sort_by, ascending, limit = (), None, True, None
+    offset, page_size, total_count = 0, None, None
+
+    def __init__(self, filters=(), sort_by=None, ascending=True, limit=None, offset=0, page_size=None):
+        """Store request arguments; filters are parsed against actual columns"""
+        self.filters, self.sort_by = tuple(filters), sort_by
+        self.ascending, self.limit = ascending, limit
+        self.offset, self.page_size = offset, page_size
+
+    @property
+    def row_range(self):
+        """Start and stop (or None) of requested rows within the result of `top`"""
+        stops = [
+            stop for stop in (
+                self.limit, None if self.page_size is None
+                else self.offset + self.page_size
+            )
+            if stop is not None
+        ]
+        if stops:
+            return self.offset, max(min(stops), self.offset)
+        else:
+            return self.offset, None
+
+    def set_total_count(self, n_rows):
+        """Store number of rows in the full result (as limited by `top`)"""
+        if self.limit is None:
+            self.total_count = n_rows
+        else:
+            self.total_count = min(n_rows, self.limit)
+
+    def parse(self, columns):
+        """Expression tree of filters, or None if cannot be evaluated here"""
+        if (self.sort_by is not None) and (self.sort_by not in columns):
+            raise ValueError("Unknown field (column): " + self.sort_by)
+        return parse_filters(self.filters or None, columns)
+
+    def to_sql_where(self, column_types):
+        """Compile filters to WHERE; None if cannot be pushed down"""
+        try:
+            expression = self.parse(list(column_types))
+        except ValueError:
+            return None
+        if expression is None:
+            return "", []
+        compiled = expression.to_sql(column_types)
+        if compiled is None:
+            return None
+        else:
+            return " WHERE " + compiled[0], list(compiled[1])
+
+    def to_sql(self, column_types):
+        """Compile to WHERE, ORDER BY, LIMIT, OFFSET; None if cannot be pushed down"""
+        compiled_where = self.to_sql_where(column_types)
+        if compiled_where is None:
+            return None
+        query, params = compiled_where
+        if self.sort_by is not None:
+            quoted = quote_sql_name(self.sort_by)
+            query += " ORDER BY {} IS NULL, {} {}, rowid".format(
+                quoted, quoted, "ASC" if self.ascending else "DESC"
+            )
+        else:
+            query += " ORDER BY rowid"
+        start, stop = self.row_range
+        if (stop is not None) or start:
+            query += " LIMIT ?"
+            params.append(-1 if stop is None else stop - start)
+        if start:
+            query += " OFFSET ?"
+            params.append(start)
+        return query, params
+
+    def to_indices(self, columns, get_column, n_rows):
+        """Evaluate over numpy columns; positions of requested rows in order, or None"""
+        try:
+            expression = self.parse(columns)
+            if expression is None:
+                positions = arange(n_rows)
+            else:
+                positions = flatnonzero(expression.evaluate(get_column))
+        except (ValueError, TypeError):
+            return None
+        self.set_total_count(len(positions))
+        start, stop = self.row_range
+        if self.sort_by is not None:
+            sort_values = get_column(self.sort_by)[positions]
+            if stop is not None:
+                order = stable_top_k(sort_values, stop, self.ascending)
+            else:
+                order = stable_argsort(sort_values, self.ascending)
+            positions = positions[order]
+        return positions[start:stop]
+
+
+def parse_top(top):
+    """Row limit from `top` request argument, or None if not a positive integer"""
+    if isinstance(top, str) and top.isdigit() and int(top):
+        return int(top)
+    else:
+        return None
+
+
+def parse_page(display_rargs, fingerprint):
+    """Offset and page size from `offset` and `limit`, or from `cursor`; None if not paged"""
+    offset, limit = display_rargs["offset"], display_rargs["limit"]
+    if display_rargs["cursor"] is not None:
+        if (offset is not None) or (limit is not None):
+            raise ValueError("`cursor` cannot be combined with `offset`, `limit`")
+        return decode_cursor(display_rargs["cursor"], fingerprint)
+    elif (offset is None) and (limit is None):
+        return None
+    if offset is None:
+        offset = 0
+    elif isinstance(offset, str) and offset.isdigit():
+        offset = int(offset)
+    else:
+        raise ValueError("`offset` must be a non-negative integer")
+    if limit is not None:
+        limit = parse_top(limit)
+        if limit is None:
+            raise ValueError("`limit` must be a positive integer")
+    return offset, limit
+
+
+def get_page_fingerprint(*request_parts):
+    """Short digest of everything that determines the order of rows"""
+    return sha512(repr(request_parts).encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(offset, page_size, fingerprint):
+    """Opaque continuation token for the page at `offset`"""
+    token = dumps([offset, page_size, fingerprint]).encode("utf-8")
+    return urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def decode_cursor(cursor, fingerprint):
+    """Offset and page size from a continuation token issued for the same request"""
+    try:
+        token = urlsafe_b64decode((cursor + "=" * (-len(cursor) % 4)).encode())
+        offset, page_size, cursor_fingerprint = loads(token.decode("utf-8"))
+    except (BinasciiError, UnicodeDecodeError, ValueError, TypeError):
+        raise ValueError("Malformed `cursor`")
+    is_valid = isinstance(offset, int) and (offset >= 0) and (
+        isinstance(page_size, int) and (page_size > 0)
+    )
+    if not is_valid:
+        raise ValueError("Malformed `cursor`")
+    elif cursor_fingerprint != fingerprint:
+        raise ValueError(
+            "`cursor` does not match this request, or the table has changed"
+        )
+    else:
+        return offset, page_size
+
+
+def get_next_cursor(offset, page_size, total_count, fingerprint):
+    """Continuation token for the page after this one; None on the last page"""
+    if (page_size is None) or (offset + page_size >= total_count):
+        return None
+    else:
+        return encode_cursor(offset + page_size, page_size, fingerprint)
+
+
+def plan_query(data_filter_rargs, top=None, page=None):
+    """Combine `filter`, `sort_by`, `ascending`, `top` and page into a TableQuery"""
+    field_filters_raw = data_filter_rargs["filter"]
+    if field_filters_raw is None:
+        field_filters = []
+    elif not isinstance(field_filters_raw, (list, tuple, set)):
+        field_filters = [field_filters_raw]
+    else:
+        field_filters = field_filters_raw
+    if data_filter_rargs["sort_by"] is not None:
+        sort_by = sub(r'(^\')|(\'$)', "", data_filter_rargs["sort_by"])
+    else:
+        sort_by = None
+    limit = parse_top(top)
+    offset, page_size = page or (0, None)
+    is_needed = field_filters or (sort_by is not None) or (
+        limit is not None) or (page is not None)
+    if is_needed:
+        return TableQuery(
+            field_filters, sort_by, data_filter_rargs["ascending"], limit,
+            offset, page_size
+        )
+    else:
+        return None
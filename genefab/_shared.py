@@ -0,0 +1,270 @@
+from genefab._util import TEMPORARY_FILE_PREFIX
+from genefab._dbpool import SQLITE_POOL
+from os import environ, path, makedirs, replace, remove, getpid, kill, stat
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from sqlite3 import OperationalError
+from hashlib import sha512
+from time import time
+
+try:
+    from pyarrow import Table, memory_map, ipc, ArrowException
+except ImportError:
+    Table = None
+
+
+SHARED_TABLES_DIR = environ.get("GENEFAB_SHARED_TABLES_DIR") or None # /dev/shm/...
+SHARED_TABLES_MAXBYTES = int(
+    environ.get("GENEFAB_SHARED_TABLES_MAXBYTES", 1024*1024*1024)
+)
+SHARED_TABLES_MIN_READS = int(
+    environ.get("GENEFAB_SHARED_TABLES_MIN_READS", 2) # reads before publishing
+)
+REGISTRY_SCHEMA = "('key' TEXT PRIMARY KEY, 'accession' TEXT, 'file' TEXT, 'date' INTEGER, 'bytes' INTEGER, 'published' REAL)"
+ATTACHMENTS_SCHEMA = "('key' TEXT, 'pid' INTEGER, PRIMARY KEY ('key', 'pid'))"
+
+
+def is_alive(pid):
+    """Check if process exists (attachments of crashed workers do not count)"""
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedTableRegistry():
+    """Hot tables published once as Arrow files in shared memory and memory-mapped read-only by every worker"""
+    hits, misses, published, evictions, invalidations = 0, 0, 0, 0, 0
+
+    def __init__(self, shared_dir=SHARED_TABLES_DIR, maxbytes=SHARED_TABLES_MAXBYTES, min_reads=SHARED_TABLES_MIN_READS):
+        """Disabled unless a directory (preferably on tmpfs) is given and pyarrow is available"""
+        self.shared_dir, self.maxbytes = shared_dir, maxbytes
+        self.min_reads = min_reads
+        self.enabled = (shared_dir is not None) and (Table is not None)
+        if self.enabled:
+            self.registry_name = path.join(shared_dir, "registry.sqlite3")
+        self._attached = {} # key -> (date, file, inode, arrow table); this process only
+        self._reads = {} # key -> reads from the table store before publishing
+        self._lock = Lock()
+
+    def get_key(self, accession, assay_name, table_name):
+        """Registry key and shared file name of a table"""
+        key = "/".join([accession, assay_name, table_name])
+        digest = sha512(key.encode("utf-8")).hexdigest()[:32]
+        return key, path.join(self.shared_dir, accession, digest + ".arrow")
+
+    def registry(self):
+        """Pooled handle to the registry database"""
+        makedirs(self.shared_dir, exist_ok=True)
+        return SQLITE_POOL.connection(self.registry_name)
+
+    def create_tables(self, db):
+        """Create registry and attachment tables"""
+        db.execute("CREATE TABLE IF NOT EXISTS 'shared' " + REGISTRY_SCHEMA)
+        db.execute("CREATE TABLE IF NOT EXISTS 'attachments' " + ATTACHMENTS_SCHEMA)
+
+    def get(self, accession, assay_name, table_name, expect_date):
+        """Dataframe backed by the shared copy of the table; None if not published for this date"""
+        if not self.enabled:
+            return None
+        key, _ = self.get_key(accession, assay_name, table_name)
+        self.prune() # other processes may have unpublished tables mapped here
+        with self._lock:
+            date, _, _, table = self._attached.get(key, (None,)*4)
+        if date != expect_date:
+            table = self.attach(key, expect_date)
+        with self._lock:
+            if table is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if table is not None: # columns without nulls are not copied
+            return table.to_pandas(split_blocks=True)
+
+    def attach(self, key, expect_date):
+        """Memory-map published file and count this process as its user"""
+        self.detach(key)
+        try:
+            with self.registry() as db:
+                self.create_tables(db)
+                row = db.execute(
+                    "SELECT file FROM 'shared' WHERE key = ? AND date = ?",
+                    [key, expect_date]
+                ).fetchone()
+                if row is None:
+                    return None
+                shared_file, = row
+                inode = stat(shared_file).st_ino
+                table = ipc.open_file(memory_map(shared_file)).read_all()
+                db.execute(
+                    "INSERT OR IGNORE INTO 'attachments' VALUES (?, ?)",
+                    [key, getpid()]
+                )
+                db.commit()
+        except (OSError, ArrowException, OperationalError):
+            return None
+        with self._lock:
+            self._attached[key] = expect_date, shared_file, inode, table
+        return table
+
+    def detach(self, key):
+        """Drop this process' mapping of a table"""
+        with self._lock:
+            if self._attached.pop(key, None) is None:
+                return
+        try:
+            with self.registry() as db:
+                db.execute(
+                    "DELETE FROM 'attachments' WHERE key = ? AND pid = ?",
+                    [key, getpid()]
+                )
+                db.commit()
+        except OperationalError:
+            pass
+
+    def prune(self):
+        """Detach tables whose shared file was removed or replaced, so that their pages are freed"""
+        stale = []
+        with self._lock:
+            for key, (_, shared_file, inode, _) in self._attached.items():
+                try:
+                    if stat(shared_file).st_ino != inode:
+                        stale.append(key)
+                except FileNotFoundError:
+                    stale.append(key)
+        for key in stale:
+            self.detach(key)
+
+    def offer(self, accession, assay_name, table_name, date, table_data):
+        """Count a read from the table store; publish the table once it is hot"""
+        if not self.enabled:
+            return
+        key, shared_file = self.get_key(accession, assay_name, table_name)
+        with self._lock:
+            reads = self._reads.get(key, 0) + 1
+            self._reads[key] = reads
+        if reads >= self.min_reads:
+            try:
+                self.publish(key, accession, shared_file, date, table_data)
+            except (OSError, ArrowException, OperationalError):
+                pass
+            with self._lock:
+                self._reads.pop(key, None)
+
+    def publish(self, key, accession, shared_file, date, table_data):
+        """Write uncompressed Arrow file (so that mappings are zero-copy) and register it"""
+        table = Table.from_pandas(table_data, preserve_index=True)
+        if table.nbytes > self.maxbytes:
+            return
+        makedirs(path.dirname(shared_file), exist_ok=True)
+        with NamedTemporaryFile(dir=path.dirname(shared_file), prefix=TEMPORARY_FILE_PREFIX, delete=False) as tmp:
+            try:
+                with ipc.new_file(tmp, table.schema) as writer:
+                    writer.write_table(table)
+            except:
+                tmp.close()
+                remove(tmp.name)
+                raise
+        # workers that mapped the previous file keep it until they detach:
+        replace(tmp.name, shared_file)
+        with self.registry() as db:
+            self.create_tables(db)
+            db.execute(
+                "INSERT OR REPLACE INTO 'shared' VALUES (?, ?, ?, ?, ?, ?)", [
+                    key, accession, shared_file, date,
+                    path.getsize(shared_file), time(),
+                ]
+            )
+            db.commit()
+        with self._lock:
+            self.published += 1
+        self.trim()
+
+    def trim(self):
+        """Unpublish tables above maxbytes: ones with no live users first, then oldest"""
+        with self.registry() as db:
+            rows = db.execute(
+                "SELECT key, file, bytes, published FROM 'shared'"
+            ).fetchall()
+            pids = {}
+            for key, pid in db.execute("SELECT key, pid FROM 'attachments'"):
+                pids.setdefault(key, set()).add(pid)
+            dead_pids = {
+                pid for key_pids in pids.values() for pid in key_pids
+                if not is_alive(pid)
+            }
+            db.executemany(
+                "DELETE FROM 'attachments' WHERE pid = ?",
+                [[pid] for pid in dead_pids]
+            )
+            refs = {k: len(p - dead_pids) for k, p in pids.items()}
+            total_bytes = sum(row[2] for row in rows)
+            evicted = []
+            for key, shared_file, nbytes, _ in sorted(
+                    rows, key=lambda row: (refs.get(row[0], 0), row[3])):
+                if total_bytes <= self.maxbytes:
+                    break
+                evicted.append([key])
+                total_bytes -= nbytes
+                try:
+                    remove(shared_file)
+                except FileNotFoundError:
+                    pass
+            db.executemany("DELETE FROM 'shared' WHERE key = ?", evicted)
+            db.executemany("DELETE FROM 'attachments' WHERE key = ?", evicted)
+            db.commit()
+        with self._lock:
+            self.evictions += len(evicted)
+        self.prune()
+
+    def invalidate(self, accession):
+        """Unpublish and detach all tables of accession (its file dates have changed)"""
+        if not self.enabled:
+            return
+        prefix = accession + "/"
+        with self._lock:
+            keys = [k for k in self._attached if k.startswith(prefix)]
+            for key in list(self._reads):
+                if key.startswith(prefix):
+                    del self._reads[key]
+            self.invalidations += 1
+        for key in keys:
+            self.detach(key)
+        try:
+            with self.registry() as db:
+                self.create_tables(db)
+                rows = db.execute(
+                    "SELECT key, file FROM 'shared' WHERE accession = ?",
+                    [accession]
+                ).fetchall()
+                for _, shared_file in rows:
+                    try:
+                        remove(shared_file)
+                    except FileNotFoundError:
+                        pass
+                db.execute("DELETE FROM 'shared' WHERE accession = ?", [accession])
+                db.executemany(
+                    "DELETE FROM 'attachments' WHERE key = ?",
+                    [[key] for key, _ in rows]
+                )
+                db.commit()
+        except OperationalError:
+            pass
+        self.prune()
+
+    @property
+    def stats(self):
+        """Hit/miss counters and number of tables attached in this process"""
+        with self._lock:
+            return {
+                "enabled": self.enabled, "attached": len(self._attached),
+                "hits": self.hits, "misses": self.misses,
+                "published": self.published, "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+SHARED_TABLES = SharedTableRegistry()
@@ -1,32 +1,44 @@
-from genefab import GeneLabJSONException, GeneLabDataManagerException
+from genefab import GeneLabDataManagerException
 from os import remove, path
-from requests import get
+from genefab._upstream import UPSTREAM
 from requests.exceptions import InvalidSchema
 from urllib.error import URLError
-from contextlib import closing
-from sqlite3 import connect, OperationalError
+from sqlite3 import OperationalError
 from hashlib import sha512
 from pandas import read_csv, read_sql_query, DataFrame, Index, merge, concat
+from pandas import RangeIndex
+from numpy import full
 from pandas.io.sql import DatabaseError as PandasDatabaseError
 from tempfile import TemporaryDirectory
 from genefab._util import STORAGE_PREFIX, DELIM_AS_IS
-from genefab._util import guess_format, data_rargs_digest
-from genefab._display import fix_cols
-from re import sub, search, IGNORECASE
+from genefab._util import guess_format
+from genefab._dbpool import SQLITE_POOL
+from genefab._metrics import METRICS
+from genefab._display import fix_cols, STREAMING_CHUNK_ROWS
+from genefab._query import any_below_expression, get_frame_column_getter
+from re import sub
 from math import ceil
+from uuid import uuid4
 
 
 MAX_TABLE_PART_WITDH = 512
 TABLE_PARTS_SCHEMA = "('name' TEXT, 'part_name' TEXT)"
+TABLE_DATES_SCHEMA = "('name' TEXT, 'date' INTEGER)"
+METADATA_INDICES = {
+    "table_parts": "table_parts_name", "table_dates": "table_dates_name",
+}
 
 
+@METRICS.timed("download_table")
 def download_table(accession, assay_name, filemask, url, verbose=False, http_fallback=True):
     """Download and interpret table file"""
     try:
-        stream = get(url, stream=True)
+        stream = UPSTREAM.get(url, stream=True)
     except InvalidSchema:
         if http_fallback:
-            stream = get(sub(r'^ftp:\/\/', "http://", url), stream=True)
+            stream = UPSTREAM.get(
+                sub(r'^ftp:\/\/', "http://", url), stream=True
+            )
         else:
             raise
     if stream.status_code != 200:
@@ -45,24 +57,15 @@ def download_table(accession, assay_name, filemask, url, verbose=False, http_fal
         if total_bytes != written_bytes:
             remove(target_file)
             raise URLError("Failed to download the correct number of bytes")
+        METRICS.count("downloaded_bytes", written_bytes)
         sep, compression = guess_format(target_file)
         return read_csv(target_file, sep=sep, compression=compression)
 
 
 def get_padj_filtered_repr_df(repr_df, any_below):
     """Only pass entries where at least one Adj-p-value field is significant"""
-    cutoff = float(any_below)
-    filterable_fields = [
-        field for field in repr_df.columns
-        if search(r'^adj-p-value', field, flags=IGNORECASE)
-    ]
-    indexer = None
-    for field in filterable_fields:
-        if indexer is None:
-            indexer = (repr_df[field] < cutoff)
-        else:
-            indexer |= (repr_df[field] < cutoff)
-    return repr_df[indexer]
+    expression = any_below_expression(repr_df.columns, any_below)
+    return repr_df[expression.evaluate(get_frame_column_getter(repr_df))]
 
 
 def melt_table_data(repr_df, melting, cols_to_fix={"Unnamed: 0": "Sample Name"}):
@@ -94,8 +97,9 @@ def melt_table_data(repr_df, melting, cols_to_fix={"Unnamed: 0": "Sample Name"})
         return melted_data
 
 
+@METRICS.timed("format_table_data")
 def format_table_data(repr_df, assay, data_rargs, cols_to_fix={"Unnamed: 0"}):
-    """Format file data accoring to rargdict and melting"""
+    """Format file data accoring to rargdict (melting is done separately)"""
     if data_rargs["name_delim"] != DELIM_AS_IS:
         conv_delim = lambda f: sub(r'[._-]', data_rargs["name_delim"], f)
         repr_df.columns = repr_df.columns.map(conv_delim)
@@ -104,157 +108,290 @@ def format_table_data(repr_df, assay, data_rargs, cols_to_fix={"Unnamed: 0"}):
                 repr_df[col_to_fix] = repr_df[col_to_fix].apply(conv_delim)
     if data_rargs["any_below"] is not None:
         repr_df = get_padj_filtered_repr_df(repr_df, data_rargs["any_below"])
+    return repr_df
+
+
+def melt_formatted_table(repr_df, assay, data_rargs):
+    """Melt (and describe) formatted table in memory, if requested"""
     if data_rargs["descriptive"]:
-        repr_df = melt_table_data(repr_df, melting=assay.annotation().T)
+        return melt_table_data(repr_df, melting=assay.annotation().T)
     elif data_rargs["melted"]:
-        repr_df = melt_table_data(
+        return melt_table_data(
             repr_df,
             melting=list(assay.annotation().T.columns)
         )
-    return repr_df
+    else:
+        return repr_df
 
 
-def retrieve_table_data(assay, filemask, data_rargs):
-    """Find file URL that matches filemask, redirect to download or interpret"""
-    try:
-        url = assay._get_file_url(filemask)
-    except GeneLabJSONException:
-        raise ValueError("multiple files match mask")
-    if url is None:
-        raise FileNotFoundError
-    repr_df = download_table(
-        assay.parent.accession, assay.name, filemask, url
-    )
-    return format_table_data(repr_df, assay, data_rargs)
+def iterate_melted_blocks(repr_df, assay, data_rargs, chunk_rows=STREAMING_CHUNK_ROWS, cols_to_fix={"Unnamed: 0": "Sample Name"}):
+    """Blocks of what melt_formatted_table() would return, in the same order;
+    None if the result cannot be reproduced blockwise (column name clashes)"""
+    annotation = assay.annotation()
+    samples, fields = list(annotation.index), list(annotation.columns)
+    if cols_to_fix:
+        repr_df = fix_cols(repr_df, cols_to_fix)
+    columns = set(repr_df.columns)
+    id_columns = [c for c in repr_df.columns if c not in set(samples)]
+    if data_rargs["descriptive"]:
+        reserved = {"Sample Name", "value", "index"}
+        clashes = (reserved | set(fields)) & set(id_columns)
+        clashes |= reserved & set(fields)
+    else:
+        clashes = {"index", "value"} & set(id_columns)
+    if clashes or (not samples) or (not annotation.index.is_unique) or (
+            not repr_df.columns.is_unique) or (not set(samples) <= columns):
+        return None
+    # same dtype as a single melt(), which interleaves all value columns:
+    value_dtype = repr_df[samples].iloc[:0].values.dtype
+    n_rows = repr_df.shape[0]
+    if data_rargs["descriptive"]:
+        output_columns = ["Sample Name"] + fields + id_columns + ["value"]
+    else: # "Sample Name" may repeat, like in melt(), if it is also an id column
+        output_columns = id_columns + ["Sample Name", "value"]
+    def iterator():
+        for sample_position, sample in enumerate(samples):
+            sample_values = repr_df[sample].values
+            for start in range(0, max(n_rows, 1), chunk_rows):
+                stop = min(start + chunk_rows, n_rows)
+                offset = sample_position * n_rows
+                block_data = {
+                    column: repr_df[column].values[start:stop]
+                    for column in id_columns
+                }
+                block_data["Sample Name"] = full(
+                    stop - start, sample, dtype=object
+                )
+                if data_rargs["descriptive"]:
+                    for field in fields:
+                        block_data[field] = full(
+                            stop - start, annotation.at[sample, field],
+                            dtype=object
+                        )
+                block_data["value"] = sample_values[start:stop].astype(
+                    value_dtype, copy=False
+                )
+                yield DataFrame(
+                    block_data, columns=output_columns,
+                    index=RangeIndex(offset + start, offset + stop)
+                )
+    return iterator()
 
 
 def get_multipart_sql_table_part_names(table_name, db):
-    query_mask = "SELECT part_name FROM 'table_parts' WHERE name = '{}'"
     try:
-        part_names_series = read_sql_query(query_mask.format(table_name), db)
-        if len(part_names_series):
-            return part_names_series["part_name"]
-        else:
-            return [table_name]
-    except (PandasDatabaseError, OperationalError):
+        part_names = [
+            part_name for part_name, in db.execute(
+                "SELECT part_name FROM 'table_parts' WHERE name = ? " +
+                "ORDER BY rowid", [table_name]
+            )
+        ]
+    except OperationalError:
         return [table_name]
+    return part_names or [table_name]
 
 
+@METRICS.timed("read_multipart_sql_table")
 def read_multipart_sql_table(table_name, db):
-    part_names = get_multipart_sql_table_part_names(table_name, db)
-    table_parts, successful_parts = [], set()
-    for part_name in part_names:
-        query = "SELECT * FROM '{}'".format(part_name)
-        try:
-            table_parts.append(read_sql_query(query, db, index_col="index"))
-            successful_parts.add(part_name)
-        except:
-            for part_name in successful_parts:
-                db.cursor().execute(
-                    "DROP TABLE IF EXISTS '{}'".format(part_name)
-                )
-                db.commit()
-            raise
+    """Read all parts within one transaction, i.e. from one consistent snapshot"""
+    db.cursor().execute("BEGIN")
+    try:
+        part_names = get_multipart_sql_table_part_names(table_name, db)
+        table_parts = [
+            read_sql_query(
+                "SELECT * FROM '{}'".format(part_name), db, index_col="index"
+            )
+            for part_name in part_names
+        ]
+    finally:
+        db.rollback()
     return concat(table_parts, axis=1)
 
 
-def destroy_multipart_sql_table(table_name, db, drop_date=True):
-    part_names = get_multipart_sql_table_part_names(table_name, db)
+def destroy_multipart_sql_table(table_name, db, drop_date=True, keep_parts=()):
+    """Unregister table and drop its parts, as well as any orphaned parts"""
+    part_names = set(get_multipart_sql_table_part_names(table_name, db))
+    part_names.add(table_name)
     try:
-        db.cursor().execute(
-            "DELETE FROM 'table_parts' WHERE name = '{}'".format(table_name)
-        )
-        db.commit()
+        part_names |= {
+            name for name, in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' " +
+                "AND substr(name, 1, ?) = ?",
+                [len(table_name) + 1, table_name + "-"]
+            )
+        }
     except OperationalError:
         pass
-    for part_name in part_names:
-        db.cursor().execute("DROP TABLE IF EXISTS '{}'".format(part_name))
-        db.commit()
+    if not keep_parts:
+        try:
+            db.execute(
+                "DELETE FROM 'table_parts' WHERE name = ?", [table_name]
+            )
+        except OperationalError:
+            pass
+    for part_name in part_names - set(keep_parts):
+        db.execute("DROP TABLE IF EXISTS '{}'".format(part_name))
     if drop_date:
         try:
-            db.cursor().execute(
-                "DELETE FROM 'table_dates' WHERE name = '{}'".format(table_name)
+            db.execute(
+                "DELETE FROM 'table_dates' WHERE name = ?", [table_name]
             )
-            db.commit()
         except OperationalError:
             pass
+    db.commit()
+
+
+def is_stored_date_expected(table_name, db, expect_date):
+    """Check if table_dates has exactly one matching date for table_name"""
+    try:
+        stored_dates = db.execute(
+            "SELECT date FROM 'table_dates' WHERE name = ?", [table_name]
+        ).fetchall()
+    except OperationalError:
+        stored_dates = []
+    return (
+        isinstance(stored_dates, list) and (len(stored_dates) == 1) and
+        isinstance(stored_dates[0], tuple) and (len(stored_dates[0]) == 1)
+        and (stored_dates[0][0] == expect_date)
+    )
 
 
-def try_sqlite(accession, assay_name, data_rargs, expect_date):
+def try_sqlite(accession, assay_name, table_name, expect_date):
     """Try to load dataframe from DB_NAME"""
-    table_name = data_rargs_digest(data_rargs)
     db_name = path.join(
         STORAGE_PREFIX, accession + "-" + assay_name + ".sqlite3"
     )
-    with closing(connect(db_name)) as db:
-        date_query_mask = "SELECT date FROM 'table_dates' WHERE name = '{}'"
-        date_query = date_query_mask.format(table_name)
-        try:
-            stored_dates = db.cursor().execute(date_query).fetchall()
-        except OperationalError:
-            stored_dates = []
-        is_stored_date_expected = (
-            isinstance(stored_dates, list) and (len(stored_dates) == 1) and
-            isinstance(stored_dates[0], tuple) and (len(stored_dates[0]) == 1)
-            and (stored_dates[0][0] == expect_date)
-        )
-        if is_stored_date_expected:
+    with SQLITE_POOL.connection(db_name) as db:
+        if is_stored_date_expected(table_name, db, expect_date):
             try:
                 return read_multipart_sql_table(table_name, db)
             except (PandasDatabaseError, OperationalError):
                 pass
-        # otherwise, the table is too old and needs to be destroyed:
-        destroy_multipart_sql_table(table_name, db)
+        # otherwise, the table is too old; it is replaced by dump_to_sqlite()
         return None
 
 
-def write_multipart_sql_table(table_data, table_name, db):
-    if table_data.shape[1] <= MAX_TABLE_PART_WITDH:
-        table_data.to_sql(table_name, db)
-        db.commit()
-    else:
-        query = "CREATE TABLE IF NOT EXISTS 'table_parts' " + TABLE_PARTS_SCHEMA
-        db.cursor().execute(query)
-        db.commit()
-        total_parts = int(ceil(table_data.shape[1] / MAX_TABLE_PART_WITDH))
-        for partno in range(total_parts):
-            part = table_data.iloc[
-                :,partno*MAX_TABLE_PART_WITDH:(partno+1)*MAX_TABLE_PART_WITDH
-            ]
-            part_name = table_name + "-" + str(partno)
-            query = "INSERT INTO '{}' (name, part_name) VALUES ('{}', '{}')"
-            db.cursor().execute(
-                query.format("table_parts", table_name, part_name)
+def query_sqlite(accession, assay_name, table_name, expect_date, query):
+    """Evaluate TableQuery in SQL; None if not possible"""
+    db_name = path.join(
+        STORAGE_PREFIX, accession + "-" + assay_name + ".sqlite3"
+    )
+    if not path.isfile(db_name):
+        return None
+    with SQLITE_POOL.connection(db_name) as db:
+        if not is_stored_date_expected(table_name, db, expect_date):
+            return None
+        part_names = list(get_multipart_sql_table_part_names(table_name, db))
+        if len(part_names) != 1:
+            if query.filters or (query.sort_by is not None):
+                return None
+            else: # plain row range of a wide table
+                return read_multipart_sql_table_rows(part_names, db, query)
+        column_types = {
+            column_info[1]: column_info[2] for column_info in
+            db.cursor().execute("PRAGMA table_info('{}')".format(part_names[0]))
+            if column_info[1] != "index"
+        }
+        compiled_query = query.to_sql(column_types)
+        if compiled_query is None:
+            return None
+        sql_suffix, params = compiled_query
+        where_suffix, where_params = query.to_sql_where(column_types)
+        db.cursor().execute("BEGIN")
+        try:
+            total_count, = db.cursor().execute(
+                "SELECT COUNT(*) FROM '{}'".format(part_names[0]) + where_suffix,
+                where_params
+            ).fetchone()
+            table_data = read_sql_query(
+                "SELECT * FROM '{}'".format(part_names[0]) + sql_suffix, db,
+                params=params, index_col="index"
             )
-            part.to_sql(part_name, db)
-            db.commit()
+        except (PandasDatabaseError, OperationalError):
+            return None
+        finally:
+            db.rollback()
+        query.set_total_count(total_count)
+        return table_data
 
 
-def dump_to_sqlite(accession, assay_name, data_rargs, table_data, set_date):
+def read_multipart_sql_table_rows(part_names, db, query):
+    """Read the row range of an unfiltered, unsorted query from all parts"""
+    start, stop = query.row_range
+    db.cursor().execute("BEGIN")
+    try:
+        total_count, = db.cursor().execute(
+            "SELECT COUNT(*) FROM '{}'".format(part_names[0])
+        ).fetchone()
+        table_parts = [
+            read_sql_query(
+                "SELECT * FROM '{}' ORDER BY rowid LIMIT ? OFFSET ?".format(
+                    part_name
+                ),
+                db, params=[-1 if stop is None else stop - start, start],
+                index_col="index"
+            )
+            for part_name in part_names
+        ]
+    except (PandasDatabaseError, OperationalError):
+        return None
+    finally:
+        db.rollback()
+    query.set_total_count(total_count)
+    return concat(table_parts, axis=1)
+
+
+def write_multipart_sql_table(table_data, table_name, db):
+    """Write parts under fresh names; they stay invisible until published"""
+    generation = uuid4().hex
+    total_parts = max(1, int(ceil(table_data.shape[1] / MAX_TABLE_PART_WITDH)))
+    part_names = []
+    for partno in range(total_parts):
+        part = table_data.iloc[
+            :,partno*MAX_TABLE_PART_WITDH:(partno+1)*MAX_TABLE_PART_WITDH
+        ]
+        part_name = "{}-{}-{}".format(table_name, generation, partno)
+        part.to_sql(part_name, db)
+        part_names.append(part_name)
+    return part_names
+
+
+def create_metadata_tables(db):
+    """Create table_parts and table_dates, indexed by table name"""
+    db.execute("CREATE TABLE IF NOT EXISTS 'table_parts' " + TABLE_PARTS_SCHEMA)
+    db.execute("CREATE TABLE IF NOT EXISTS 'table_dates' " + TABLE_DATES_SCHEMA)
+    for metadata_table, index_name in METADATA_INDICES.items():
+        db.execute("CREATE INDEX IF NOT EXISTS '{}' ON '{}' (name)".format(
+            index_name, metadata_table
+        ))
+
+
+def publish_multipart_sql_table(table_name, part_names, set_date, db):
+    """Point table_parts and table_dates to the new parts"""
+    create_metadata_tables(db)
+    db.execute("DELETE FROM 'table_parts' WHERE name = ?", [table_name])
+    db.executemany(
+        "INSERT INTO 'table_parts' (name, part_name) VALUES (?, ?)",
+        [[table_name, part_name] for part_name in part_names]
+    )
+    db.execute("DELETE FROM 'table_dates' WHERE name = ?", [table_name])
+    db.execute(
+        "INSERT INTO 'table_dates' (name, date) VALUES (?, ?)",
+        [table_name, set_date]
+    )
+    db.commit()
+
+
+def dump_to_sqlite(accession, assay_name, table_name, table_data, set_date):
     """Save transformed dataframe to DB_NAME"""
-    table_name = data_rargs_digest(data_rargs)
     db_name = path.join(
         STORAGE_PREFIX, accession + "-" + assay_name + ".sqlite3"
     )
-    with closing(connect(db_name)) as db:
-        destroy_multipart_sql_table(table_name, db, drop_date=False)
-        write_multipart_sql_table(table_data, table_name, db)
-        test_query_mask = "SELECT date FROM 'table_dates' WHERE name = '{}'"
-        test_query = test_query_mask.format(table_name)
-        try:
-            date_test = db.cursor().execute(test_query).fetchall()
-        except OperationalError:
-            new_date_table = DataFrame(
-                data=[[table_name, set_date]],
-                index=[0], columns=["name", "date"]
-            )
-            new_date_table.to_sql("table_dates", db, index=False)
-        else:
-            if len(date_test):
-                qmask = "UPDATE 'table_dates' SET date = {} WHERE name = '{}'"
-                query = qmask.format(set_date, table_name)
-            else:
-                qmask = "INSERT INTO 'table_dates' (name, date) VALUES ('{}', {})"
-                query = qmask.format(table_name, set_date)
-            db.cursor().execute(query)
-        db.commit()
+    # one transaction; readers see either old or new parts:
+    with SQLITE_POOL.connection(db_name) as db, db.transaction():
+        part_names = write_multipart_sql_table(table_data, table_name, db)
+        publish_multipart_sql_table(table_name, part_names, set_date, db)
+        # drop previous generation (and legacy unversioned) parts:
+        destroy_multipart_sql_table(
+            table_name, db, drop_date=False, keep_parts=part_names
+        )
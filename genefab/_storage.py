@@ -0,0 +1,479 @@
+from genefab._exceptions import GeneLabJSONException
+from genefab._util import STORAGE_PREFIX, TEMPORARY_FILE_PREFIX
+from genefab._sqlite import try_sqlite, dump_to_sqlite, query_sqlite
+from genefab._sqlite import is_stored_date_expected
+from genefab._sqlite import read_multipart_sql_table
+from genefab._sqlite import download_table, format_table_data
+from genefab._display import get_cols_renamer
+from genefab._budget import STORAGE_BUDGET
+from genefab._dbpool import SQLITE_POOL
+from genefab._shared import SHARED_TABLES
+from genefab._metrics import METRICS
+from os import environ, path, makedirs, replace, remove, listdir
+from hashlib import sha512
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
+from fcntl import flock, LOCK_EX, LOCK_UN
+from sqlite3 import OperationalError
+from tempfile import NamedTemporaryFile
+from struct import unpack
+from json import loads, dumps
+from sys import stderr
+
+try:
+    from pyarrow import Table, memory_map, ipc, ArrowException, schema
+except ImportError:
+    Table = None
+
+
+ARROW_DATE_KEY = b"genefab_date"
+ARROW_COMPRESSION_KEY = b"genefab_compression"
+ARROW_MAGIC, ARROW_CONTINUATION = b"ARROW1", b"\xff\xff\xff\xff"
+RAW_TABLES_NAMESPACE = "files"
+LOCKS_DIR = path.join(STORAGE_PREFIX, "locks")
+ARTIFACT_READ_SIZE = 1048576
+TABLE_STORE = environ.get(
+    "GENEFAB_TABLE_STORE", "sqlite" if Table is None else "arrow"
+)
+
+TABLE_COMPRESSION = environ.get("GENEFAB_TABLE_COMPRESSION", "none") # zstd, lz4
+TABLE_CHUNK_ROWS = int(
+    environ.get("GENEFAB_TABLE_CHUNK_ROWS", 65536) # rows per compressed block
+)
+
+if (TABLE_STORE != "sqlite") and (Table is None):
+    print("Warning: pyarrow not available, using SQLite table store", file=stderr)
+    TABLE_STORE = "sqlite"
+
+
+def is_compression_available(compression):
+    """Check if IPC buffer compression with this codec is supported (pyarrow>=2)"""
+    try:
+        from pyarrow import Codec
+        return hasattr(ipc, "IpcWriteOptions") and Codec.is_available(compression)
+    except (ImportError, AttributeError, ValueError, TypeError):
+        return False
+
+
+if (TABLE_COMPRESSION != "none") and (Table is not None):
+    if not is_compression_available(TABLE_COMPRESSION):
+        print(
+            "Warning: codec '{}' not available, storing uncompressed tables"
+            .format(TABLE_COMPRESSION), file=stderr
+        )
+        TABLE_COMPRESSION = "none"
+
+
+def get_arrow_file_name(accession, assay_name, table_name):
+    """Columnar files are named by the hash part of the table name"""
+    return path.join(
+        STORAGE_PREFIX, accession + "-" + assay_name,
+        table_name.split("_")[-1] + ".arrow"
+    )
+
+
+def read_arrow_date(arrow_file):
+    """Read date stored in schema metadata without touching the columns"""
+    try:
+        if hasattr(ipc, "IpcReadOptions"): # decompress buffers in parallel
+            reader = ipc.open_file(
+                memory_map(arrow_file),
+                options=ipc.IpcReadOptions(use_threads=True),
+            )
+        else:
+            reader = ipc.open_file(memory_map(arrow_file))
+        return int(reader.schema.metadata[ARROW_DATE_KEY]), reader
+    except (ArrowException, OSError, KeyError, ValueError, TypeError):
+        return None, None
+
+
+@METRICS.timed("try_arrow")
+def try_arrow(accession, assay_name, table_name, expect_date):
+    """Try to load dataframe from memory-mapped Arrow IPC file"""
+    arrow_file = get_arrow_file_name(
+        accession, assay_name, table_name
+    )
+    if not path.isfile(arrow_file):
+        return None
+    stored_date, reader = read_arrow_date(arrow_file)
+    if stored_date == expect_date:
+        try:
+            return reader.read_all().to_pandas(split_blocks=True)
+        except (ArrowException, OSError):
+            pass
+    # otherwise, the table is too old (or broken); dump_to_arrow() replaces it
+    return None
+
+
+def query_arrow(accession, assay_name, table_name, expect_date, query):
+    """Evaluate TableQuery over memory-mapped columns; None if not possible"""
+    arrow_file = get_arrow_file_name(
+        accession, assay_name, table_name
+    )
+    if not path.isfile(arrow_file):
+        return None
+    stored_date, reader = read_arrow_date(arrow_file)
+    if stored_date != expect_date:
+        return None
+    table = reader.read_all()
+    index_columns = {
+        c for c in (table.schema.pandas_metadata or {}).get("index_columns", [])
+        if isinstance(c, str) # RangeIndex may be stored as metadata only
+    }
+    positions = query.to_indices(
+        [c for c in table.column_names if c not in index_columns],
+        lambda field: table.column(field).to_numpy(), table.num_rows
+    )
+    if positions is None:
+        return None
+    else:
+        return table.take(positions).to_pandas(split_blocks=True)
+
+
+def rename_schema_fields(arrow_schema, renamer):
+    """Rename fields, also in pandas metadata"""
+    metadata = dict(arrow_schema.metadata or {})
+    if renamer and (b"pandas" in metadata):
+        pandas_metadata = loads(metadata[b"pandas"].decode())
+        for column in pandas_metadata.get("columns", []):
+            field_name = column.get("field_name")
+            if (field_name in renamer) and (column.get("name") == field_name):
+                column["name"] = column["field_name"] = renamer[field_name]
+        metadata[b"pandas"] = dumps(pandas_metadata).encode()
+    return schema(
+        [field.with_name(renamer.get(field.name, field.name)) for field in arrow_schema],
+        metadata=metadata
+    )
+
+
+def try_arrow_stream(accession, assay_name, table_name, expect_date, cols_to_fix={"Unnamed: 0": "Sample Name"}, read_size=ARTIFACT_READ_SIZE):
+    """Byte blocks of an Arrow IPC stream cut out of the stored file; only the schema is re-encoded"""
+    if TABLE_STORE == "sqlite":
+        return None
+    arrow_file = get_arrow_file_name(accession, assay_name, table_name)
+    stored_date, reader = read_arrow_date(arrow_file)
+    if stored_date != expect_date:
+        return None
+    compression = reader.schema.metadata.get(ARROW_COMPRESSION_KEY, b"none")
+    if compression != b"none": # not every client can decompress IPC buffers
+        return None
+    # file: magic, padding, stream (schema, batches, EOS), footer, footer size, magic
+    handle = open(arrow_file, "rb")
+    try:
+        file_size = path.getsize(arrow_file)
+        handle.seek(file_size - 10)
+        footer_size, magic = unpack("<i6s", handle.read(10))
+        handle.seek(8)
+        continuation, schema_size = unpack("<4si", handle.read(8))
+        if (magic != ARROW_MAGIC) or (continuation != ARROW_CONTINUATION):
+            handle.close()
+            return None
+    except:
+        handle.close()
+        raise
+    STORAGE_BUDGET.touch("file", arrow_file)
+    batches_start, stream_end = 16 + schema_size, file_size - 10 - footer_size
+    stream_schema = rename_schema_fields(
+        reader.schema, get_cols_renamer(reader.schema.names, cols_to_fix)
+    )
+    def iterator():
+        with handle:
+            yield stream_schema.serialize().to_pybytes()
+            handle.seek(batches_start)
+            remaining = stream_end - batches_start
+            while remaining > 0:
+                block = handle.read(min(read_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+    return iterator()
+
+
+def write_arrow_table(table_data, arrow_file, set_date, compression=TABLE_COMPRESSION, chunk_rows=TABLE_CHUNK_ROWS):
+    """Write dataframe with date in schema metadata; replace atomically"""
+    makedirs(path.dirname(arrow_file), exist_ok=True)
+    table = Table.from_pandas(table_data, preserve_index=True)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        ARROW_DATE_KEY: str(set_date).encode(),
+        ARROW_COMPRESSION_KEY: compression.encode(),
+    })
+    with NamedTemporaryFile(dir=path.dirname(arrow_file), prefix=TEMPORARY_FILE_PREFIX, delete=False) as tmp:
+        try:
+            if compression == "none": # one block, so that reads are zero-copy
+                with ipc.new_file(tmp, table.schema) as writer:
+                    writer.write_table(table)
+            else: # each column of each block is compressed separately
+                options = ipc.IpcWriteOptions(
+                    compression=compression, use_threads=True
+                )
+                with ipc.new_file(tmp, table.schema, options=options) as writer:
+                    writer.write_table(table, max_chunksize=chunk_rows)
+        except:
+            tmp.close()
+            remove(tmp.name)
+            raise
+    replace(tmp.name, arrow_file)
+
+
+def dump_to_arrow(accession, assay_name, table_name, table_data, set_date):
+    """Save transformed dataframe to Arrow IPC file"""
+    arrow_file = get_arrow_file_name(
+        accession, assay_name, table_name
+    )
+    write_arrow_table(table_data, arrow_file, set_date)
+
+
+def get_sqlite_db_name(accession, assay_name):
+    """Per-assay SQLite database of the legacy store"""
+    return path.join(STORAGE_PREFIX, accession + "-" + assay_name + ".sqlite3")
+
+
+def touch_table(accession, assay_name, table_name):
+    """Record use of stored table for eviction under the storage budget"""
+    arrow_file = get_arrow_file_name(accession, assay_name, table_name)
+    if (TABLE_STORE != "sqlite") and path.isfile(arrow_file):
+        STORAGE_BUDGET.touch("file", arrow_file)
+    else:
+        STORAGE_BUDGET.touch(
+            "sqlite", get_sqlite_db_name(accession, assay_name), table_name
+        )
+
+
+def try_cache(accession, assay_name, table_name, expect_date):
+    """Try to load dataframe from shared memory or the configured table store"""
+    table_data = SHARED_TABLES.get(accession, assay_name, table_name, expect_date)
+    if table_data is not None:
+        touch_table(accession, assay_name, table_name)
+        return table_data
+    if TABLE_STORE == "sqlite":
+        table_data = try_sqlite(accession, assay_name, table_name, expect_date)
+    else:
+        table_data = try_arrow(accession, assay_name, table_name, expect_date)
+    if (table_data is None) and (TABLE_STORE != "sqlite"):
+        # migration path: pick up the table from the legacy SQLite store
+        if path.isfile(get_sqlite_db_name(accession, assay_name)):
+            table_data = try_sqlite(
+                accession, assay_name, table_name, expect_date
+            )
+            if table_data is not None:
+                try:
+                    dump_to_arrow(
+                        accession, assay_name, table_name, table_data,
+                        set_date=expect_date
+                    )
+                except ArrowException:
+                    pass
+    if table_data is not None:
+        touch_table(accession, assay_name, table_name)
+        SHARED_TABLES.offer(
+            accession, assay_name, table_name, expect_date, table_data
+        )
+    return table_data
+
+
+def is_cached(accession, assay_name, table_name, expect_date):
+    """Check if the store has a current table without loading it"""
+    if TABLE_STORE != "sqlite":
+        arrow_file = get_arrow_file_name(accession, assay_name, table_name)
+        if read_arrow_date(arrow_file)[0] == expect_date:
+            return True
+    db_name = get_sqlite_db_name(accession, assay_name)
+    if path.isfile(db_name):
+        with SQLITE_POOL.connection(db_name) as db:
+            return is_stored_date_expected(table_name, db, expect_date)
+    else:
+        return False
+
+
+@METRICS.timed("query_cache")
+def query_cache(accession, assay_name, table_name, expect_date, query):
+    """Filter, sort and limit inside the table store; None if not possible"""
+    if TABLE_STORE == "sqlite":
+        table_data = query_sqlite(
+            accession, assay_name, table_name, expect_date, query
+        )
+    else:
+        table_data = query_arrow(
+            accession, assay_name, table_name, expect_date, query
+        )
+    if table_data is not None:
+        touch_table(accession, assay_name, table_name)
+    return table_data
+
+
+def dump_to_cache(accession, assay_name, table_name, table_data, set_date):
+    """Save transformed dataframe to the configured table store"""
+    if TABLE_STORE == "sqlite":
+        dump_to_sqlite(accession, assay_name, table_name, table_data, set_date)
+    else:
+        try:
+            dump_to_arrow(
+                accession, assay_name, table_name, table_data, set_date
+            )
+        except ArrowException:
+            # not representable in Arrow (e.g. mixed-type object columns):
+            dump_to_sqlite(
+                accession, assay_name, table_name, table_data, set_date
+            )
+    touch_table(accession, assay_name, table_name)
+
+
+THREAD_LOCKS, THREAD_LOCKS_GUARD = {}, Lock()
+
+
+@contextmanager
+def single_flight(accession, assay_name, table_name):
+    """Serialize fills of one table across threads and (forked) processes"""
+    key = sha512(
+        "/".join([accession, assay_name, table_name]).encode("utf-8")
+    ).hexdigest()
+    with THREAD_LOCKS_GUARD:
+        thread_lock, users = THREAD_LOCKS.get(key, (Lock(), 0))
+        THREAD_LOCKS[key] = thread_lock, users + 1
+    try:
+        with thread_lock:
+            makedirs(LOCKS_DIR, exist_ok=True)
+            with open(path.join(LOCKS_DIR, key + ".lock"), "a") as handle:
+                flock(handle, LOCK_EX)
+                try:
+                    yield
+                finally:
+                    flock(handle, LOCK_UN)
+    finally:
+        with THREAD_LOCKS_GUARD:
+            thread_lock, users = THREAD_LOCKS[key]
+            if users == 1:
+                del THREAD_LOCKS[key]
+            else:
+                THREAD_LOCKS[key] = thread_lock, users - 1
+
+
+def try_cache_or_make(accession, assay_name, table_name, expect_date, make_table):
+    """Load table from store; on miss, one caller makes and stores it, others wait"""
+    table_data = try_cache(accession, assay_name, table_name, expect_date)
+    if table_data is None:
+        with single_flight(accession, assay_name, table_name):
+            # another thread or process may have filled it while we waited:
+            table_data = try_cache(
+                accession, assay_name, table_name, expect_date
+            )
+            if table_data is None:
+                table_data = make_table()
+                dump_to_cache(
+                    accession, assay_name, table_name, table_data,
+                    set_date=expect_date
+                )
+    return table_data
+
+
+def get_artifact_file_name(accession, assay_name, table_name, extension, key):
+    """Rendered artifacts are named by the table hash and a hash of what else they depend on"""
+    return path.join(
+        STORAGE_PREFIX, accession + "-" + assay_name, "{}.{}.{}".format(
+            table_name.split("_")[-1],
+            sha512(repr(key).encode("utf-8")).hexdigest()[:32], extension
+        )
+    )
+
+
+def try_artifact(artifact_file, read_size=ARTIFACT_READ_SIZE):
+    """Iterate over text blocks of a stored artifact; None if there is none"""
+    try:
+        handle = open(artifact_file, encoding="utf-8", newline="")
+    except FileNotFoundError:
+        return None
+    STORAGE_BUDGET.touch("file", artifact_file)
+    def iterator():
+        with handle:
+            yield from iter(partial(handle.read, read_size), "")
+    return iterator()
+
+
+def tee_to_artifact(chunks, artifact_file):
+    """Pass text chunks through; store them as artifact once all have passed"""
+    artifact_dir = path.dirname(artifact_file)
+    makedirs(artifact_dir, exist_ok=True)
+    with NamedTemporaryFile(mode="w", encoding="utf-8", newline="", dir=artifact_dir, prefix=TEMPORARY_FILE_PREFIX, delete=False) as tmp:
+        try:
+            for chunk in chunks:
+                tmp.write(chunk)
+                yield chunk
+        except BaseException: # including GeneratorExit on client disconnect
+            tmp.close()
+            remove(tmp.name)
+            raise
+    replace(tmp.name, artifact_file)
+    STORAGE_BUDGET.touch("file", artifact_file)
+    # artifacts of the same table for older dates or sample orders are stale:
+    stem, _, extension = path.basename(artifact_file).split(".")
+    for basename in listdir(artifact_dir):
+        other_file = path.join(artifact_dir, basename)
+        is_sibling = basename.startswith(stem + ".") and (
+            basename.endswith("." + extension)
+        )
+        if is_sibling and (other_file != artifact_file):
+            try:
+                remove(other_file)
+            except OSError:
+                pass
+
+
+def get_raw_table_name(url):
+    """Content address of an upstream file (its date is validated separately)"""
+    return "raw_" + sha512(url.encode("utf-8")).hexdigest()
+
+
+def retrieve_table_data(assay, filemask, data_rargs):
+    """Find file URL that matches filemask, derive view from the base table"""
+    try:
+        url = assay._get_file_url(filemask)
+    except GeneLabJSONException:
+        raise ValueError("multiple files match mask")
+    if url is None:
+        raise FileNotFoundError
+    accession = assay.parent.accession
+    raw_table_name = get_raw_table_name(url)
+    file_date = assay.glds_file_dates.get(filemask, -1)
+    repr_df = try_cache_or_make(
+        accession, RAW_TABLES_NAMESPACE, raw_table_name, file_date,
+        make_table=lambda: download_table(accession, assay.name, filemask, url)
+    )
+    return format_table_data(repr_df, assay, data_rargs)
+
+
+def migrate_sqlite_store(storage_prefix=STORAGE_PREFIX, verbose=False):
+    """Convert all dated tables in legacy `*.sqlite3` files to Arrow files"""
+    if Table is None:
+        raise ImportError("pyarrow is required for the columnar table store")
+    for db_basename in sorted(listdir(storage_prefix)):
+        if (not db_basename.endswith(".sqlite3")) or (db_basename == "log.sqlite3"):
+            continue
+        store_dir = path.join(storage_prefix, db_basename[:-len(".sqlite3")])
+        db_name = path.join(storage_prefix, db_basename)
+        with SQLITE_POOL.connection(db_name) as db:
+            try:
+                dated_tables = db.cursor().execute(
+                    "SELECT name, date FROM 'table_dates'"
+                ).fetchall()
+            except OperationalError:
+                dated_tables = []
+            for table_name, date in dated_tables:
+                arrow_file = path.join(
+                    store_dir, table_name.split("_")[-1] + ".arrow"
+                )
+                if read_arrow_date(arrow_file)[0] == date:
+                    continue
+                try:
+                    write_arrow_table(
+                        read_multipart_sql_table(table_name, db),
+                        arrow_file, set_date=date
+                    )
+                except Exception as e:
+                    if verbose:
+                        print("skipping", db_basename, table_name, e, file=stderr)
+                else:
+                    if verbose:
+                        print("migrated", db_basename, table_name, file=stderr)
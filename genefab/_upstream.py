@@ -0,0 +1,108 @@
+from requests import Session
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from threading import Lock
+from os import environ, getpid
+from json import loads
+from genefab._metrics import METRICS
+
+
+UPSTREAM_POOL_CONNECTIONS = int(
+    environ.get("GENEFAB_UPSTREAM_POOL_CONNECTIONS", 4) # number of hosts
+)
+UPSTREAM_POOL_MAXSIZE = int(
+    environ.get("GENEFAB_UPSTREAM_POOL_MAXSIZE", 16) # connections per host
+)
+UPSTREAM_POOL_BLOCK = environ.get("GENEFAB_UPSTREAM_POOL_BLOCK", "0") != "0"
+UPSTREAM_CONNECT_TIMEOUT = float(
+    environ.get("GENEFAB_UPSTREAM_CONNECT_TIMEOUT", 10)
+)
+UPSTREAM_READ_TIMEOUT = float(environ.get("GENEFAB_UPSTREAM_READ_TIMEOUT", 120))
+VALIDATED_BODIES_MAXSIZE = 256
+
+
+class UpstreamClient():
+    """Keep-alive HTTP client with per-host connection pools and revalidation"""
+    revalidated, refetched, fetched = 0, 0, 0
+
+    def __init__(self, pool_connections=UPSTREAM_POOL_CONNECTIONS, pool_maxsize=UPSTREAM_POOL_MAXSIZE, pool_block=UPSTREAM_POOL_BLOCK, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT), maxsize=VALIDATED_BODIES_MAXSIZE):
+        """Store pool settings; sessions are created lazily per process"""
+        self.pool_connections, self.pool_maxsize = pool_connections, pool_maxsize
+        self.pool_block, self.timeout = pool_block, timeout
+        self.maxsize = maxsize
+        self._bodies = OrderedDict() # url -> (etag, last_modified, body)
+        self._lock = Lock()
+        self._session, self._session_pid = None, None
+
+    @property
+    def session(self):
+        """Shared requests.Session; re-created after fork (sockets are not shareable)"""
+        with self._lock:
+            if self._session_pid != getpid():
+                session = Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize, pool_block=self.pool_block
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session, self._session_pid = session, getpid()
+            return self._session
+
+    def get(self, url, stream=False, **kwargs):
+        """Plain pooled GET"""
+        return self.session.get(
+            url, stream=stream, timeout=self.timeout, **kwargs
+        )
+
+    def get_body(self, url):
+        """GET with If-None-Match/If-Modified-Since; reuse stored body on 304"""
+        with self._lock:
+            etag, last_modified, body = self._bodies.get(url, (None,)*3)
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        response = self.get(url, headers=headers)
+        if (response.status_code == 304) and (body is not None):
+            with self._lock:
+                self.revalidated += 1
+                if url in self._bodies:
+                    self._bodies.move_to_end(url)
+            return body
+        response.raise_for_status()
+        body = response.content
+        METRICS.count("downloaded_bytes", len(body))
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self._lock:
+            if headers:
+                self.refetched += 1
+            else:
+                self.fetched += 1
+            if (etag is not None) or (last_modified is not None):
+                self._bodies[url] = (etag, last_modified, body)
+                self._bodies.move_to_end(url)
+                while len(self._bodies) > self.maxsize:
+                    self._bodies.popitem(last=False)
+            else:
+                self._bodies.pop(url, None)
+        return body
+
+    def get_json(self, url):
+        """Revalidating GET, decode, parse"""
+        return loads(self.get_body(url).decode())
+
+    @property
+    def stats(self):
+        """Counters of full and conditional requests"""
+        with self._lock:
+            return {
+                "validated_bodies": len(self._bodies),
+                "fetched": self.fetched, "refetched": self.refetched,
+                "revalidated": self.revalidated,
+            }
+
+
+UPSTREAM = UpstreamClient()
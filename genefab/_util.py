@@ -5,8 +5,8 @@ from re import sub
 from hashlib import sha512
 from datetime import datetime
 from os import path
-from contextlib import closing
-from sqlite3 import connect
+from genefab._dbpool import SQLITE_POOL
+from json import dumps
 
 
 GENELAB_ROOT = "https://genelab-data.ndc.nasa.gov"
@@ -14,9 +14,19 @@ API_ROOT = "https://genelab-data.ndc.nasa.gov/genelab"
 DELIM_AS_IS = "as.is"
 DELIM_DEFAULT = "-"
 STORAGE_PREFIX = ".genelab"
+TTL_CACHE_DIR = ".genelab-ttl-cache"
+TEMPORARY_FILE_PREFIX = ".genefab-tmp-" # files being written, renamed when done
 LOG_SCHEMA = "('time' INTEGER, 'url' TEXT, 'ip' TEXT, 'exception' TEXT, 'comment' TEXT)"
 
 
+BINARY_FMT_MIMETYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "npy": "application/x-npy",
+    "npz": "application/x-npz",
+}
+
+
 DEFAULT_RARGS = Namespace(
     data_rargs = {
         "fields": None,
@@ -36,6 +46,9 @@ DEFAULT_RARGS = Namespace(
         "fmt": "tsv", # TODO: 'raw' conflictable
         "header": False, # TODO: 'top' conflictable
         "top": None,
+        "offset": None,
+        "limit": None,
+        "cursor": None,
         "showcol": None,
         "hidecol": None,
     },
@@ -48,8 +61,8 @@ DEFAULT_RARGS = Namespace(
 )
 
 
-def parse_rargs(request_args):
-    """Get all common arguments from request.args"""
+def parse_rargs(request_args, accept_mimetypes=None):
+    """Get all common arguments from request.args (and 'fmt' from Accept, if not passed)"""
     rargs = deepcopy(DEFAULT_RARGS)
     for rarg_type, rargs_of_type in DEFAULT_RARGS.__dict__.items():
         for rarg, rarg_default_value in rargs_of_type.items():
@@ -63,9 +76,22 @@ def parse_rargs(request_args):
                     getattr(rargs, rarg_type)[rarg] = False
                 else:
                     getattr(rargs, rarg_type)[rarg] = True
+    if (accept_mimetypes is not None) and ("fmt" not in request_args):
+        rargs.display_rargs["fmt"] = negotiate_fmt(
+            accept_mimetypes, default=rargs.display_rargs["fmt"]
+        )
     return rargs
 
 
+def negotiate_fmt(accept_mimetypes, default):
+    """Pick a binary fmt if the Accept header prefers it to plain text"""
+    mimetype_to_fmt = {m: f for f, m in BINARY_FMT_MIMETYPES.items()}
+    best_match = accept_mimetypes.best_match(
+        ["text/plain"] + list(mimetype_to_fmt)
+    )
+    return mimetype_to_fmt.get(best_match, default)
+
+
 def data_rargs_digest(data_rargs):
     """Convert data_rargs to a string digest"""
     raw_digest = []
@@ -77,6 +103,11 @@ def data_rargs_digest(data_rargs):
     return string_digest + "_" + hexdigest
 
 
+def canonical_rargs(rargs):
+    """Stable string form of parsed request arguments, independent of their order in the URL"""
+    return dumps(rargs.__dict__, sort_keys=True, default=str)
+
+
 def guess_format(target_file):
     """Guess whether the file is a CSV or a TSV and whether it is compressed"""
     with open(target_file, mode="rb") as handle:
@@ -115,16 +146,16 @@ def date2stamp(fd, key="date_modified", fallback_key="date_created", fallback_va
 def log(request, exception):
     """Save exception context to sqlite3 log database"""
     db_name = path.join(STORAGE_PREFIX, "log.sqlite3")
-    with closing(connect(db_name)) as db:
-        db.cursor().execute("CREATE TABLE IF NOT EXISTS 'log' " + LOG_SCHEMA)
-        db.cursor().execute(
+    with SQLITE_POOL.connection(db_name) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS 'log' " + LOG_SCHEMA)
+        db.execute(
             "INSERT INTO 'log' ('time', 'url', 'ip', 'exception', 'comment') " +
-            "VALUES({}, '{}', '{}', '{}', '{}')".format(
+            "VALUES (?, ?, ?, ?, ?)", [
                 int(datetime.timestamp(datetime.now())),
                 request.url, request.remote_addr,
                 type(exception).__name__,
                 sub(r'[^0-9A-Za-z_ ]', "_", str(exception))
-            )
+            ]
         )
         db.commit()
 
@@ -1,31 +1,68 @@
 #!/usr/bin/env python
 from sys import stderr
-from flask import Flask, request
+from flask import Flask, Response, request, g
 from flask_caching import Cache
-from genefab import GLDS, GeneLabJSONException, GeneLabException
+from genefab import GeneLabJSONException, GeneLabException
 from genefab._readme import html
 from genefab._display import display_object, traceback_printer, exception_catcher
-from genefab._util import parse_rargs
+from genefab._display import streaming_response, stream_gct
+from genefab._display import get_etag, check_not_modified, set_validators
+from genefab._display import capture_response, rendered_response
+from genefab._util import parse_rargs, data_rargs_digest, canonical_rargs
+from genefab._util import BINARY_FMT_MIMETYPES, TTL_CACHE_DIR
 from genefab._bridge import get_assay, subset_metadata, resolve_file_name, filter_table_data
-from genefab._sqlite import retrieve_table_data, try_sqlite, dump_to_sqlite
+from genefab._bridge import iterate_filtered_blocks
+from genefab._cache import GLDS_CACHE, RESPONSE_CACHE, RenderedResponse
+from genefab._storage import try_cache_or_make, query_cache
+from genefab._storage import retrieve_table_data
+from genefab._storage import get_artifact_file_name, try_artifact, tee_to_artifact
+from genefab._storage import try_arrow_stream
+from genefab._sqlite import iterate_melted_blocks, melt_formatted_table
+from genefab._query import plan_query, parse_page, get_page_fingerprint
+from genefab._query import get_next_cursor
+from genefab._upstream import UPSTREAM
+from genefab._budget import STORAGE_BUDGET
+from genefab._dbpool import SQLITE_POOL
+from genefab._shared import SHARED_TABLES
+from genefab._metrics import METRICS
 from os import environ
 from copy import deepcopy
-from urllib.request import urlopen
-from json import loads
 from pandas import DataFrame
 
 
 FLASK_DEBUG_MARKERS = {"development", "staging", "stage", "debug", "debugging"}
-CACHE_CONFIG = {"CACHE_TYPE": "filesystem", "CACHE_DIR": ".genelab-ttl-cache"}
+CACHE_CONFIG = {"CACHE_TYPE": "filesystem", "CACHE_DIR": TTL_CACHE_DIR}
 PROCESSED_XSV_REGEX = r'^GLDS-[0-9]+_(array_normalized-annotated\.txt|rna_seq(_all-samples)?_Normalized_Counts\.csv)(\.gz|\.bz2)?$'
 DEG_CSV_REGEX = r'^GLDS-[0-9]+_(array|rna_seq)(_all-samples)?_differential_expression.csv$'
 VIZ_CSV_REGEX = r'^GLDS-[0-9]+_(array|rna_seq)(_all-samples)?_visualization_output_table.csv$'
 PCA_CSV_REGEX = r'^GLDS-[0-9]+_(array|rna_seq)(_all-samples)?_visualization_PCA_table.csv$'
+DATA_ALIASES = ["processed", "deg", "viz-table", "pca"]
+FMT_NEGOTIATING_ENDPOINTS = {
+    "get_data", "get_data_plain_alias", "get_data_transformed_alias",
+}
 
 
 app = Flask("genefab")
-cache = Cache(config=CACHE_CONFIG)
-cache.init_app(app)
+cache = Cache(app, config=CACHE_CONFIG) # usable outside of app context, too
+
+
+if METRICS.enabled: # registered before flask_compress, so they see sent bodies
+    @app.before_request
+    def start_timing():
+        """Collect stage timings of this request"""
+        g.metrics_start = METRICS.start_request()
+
+    @app.after_request
+    def add_server_timing(response):
+        """Report stage timings; count bytes served"""
+        response.headers["Server-Timing"] = METRICS.server_timing(
+            g.metrics_start
+        )
+        if response.is_streamed:
+            response.response = METRICS.counted(response.response)
+        else:
+            METRICS.count("served_bytes", response.content_length or 0)
+        return response
 
 
 try:
@@ -46,11 +83,22 @@ else:
     exception_catcher = app.errorhandler(Exception)(exception_catcher)
 
 
+@METRICS.timed("get_json")
 @cache.memoize(timeout=60)
 def get_json(url):
-    """HTTP get, decode, parse"""
-    with urlopen(url) as response:
-        return loads(response.read().decode())
+    """HTTP get (pooled, revalidated upstream), decode, parse"""
+    return UPSTREAM.get_json(url)
+
+
+def remember_response(response, etag, date, accession):
+    """Add validators; keep rendered body for identical requests while the file date holds"""
+    store = lambda *fields: RESPONSE_CACHE.put(
+        etag, accession, RenderedResponse(*fields)
+    )
+    return set_validators(
+        capture_response(response, store, RESPONSE_CACHE.entry_maxbytes),
+        etag, date
+    )
 
 
 @app.route("/", methods=["GET"])
@@ -65,20 +113,60 @@ def favicon(imgtype):
     return ""
 
 
+@app.route("/cache/", methods=["GET"])
+def cache_stats():
+    """Report hit/miss counters of in-process caches"""
+    rargs = parse_rargs(request.args)
+    stats = DataFrame(
+        columns=["cache", "counter", "value"],
+        data=[
+            [cache_name, counter, value]
+            for cache_name, stats in get_cache_stats()
+            for counter, value in stats.items()
+        ]
+    )
+    return display_object(stats, rargs.display_rargs, index=False)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Per-stage latency histograms, byte counters and cache counters (Prometheus text format)"""
+    if not METRICS.enabled:
+        raise FileNotFoundError("Metrics are disabled (set GENEFAB_METRICS=1)")
+    return Response(
+        METRICS.render(get_cache_stats()),
+        mimetype="text/plain; version=0.0.4"
+    )
+
+
+def get_cache_stats():
+    """Counters of all process-level caches and pools"""
+    return [
+        ("glds", GLDS_CACHE.stats), ("responses", RESPONSE_CACHE.stats),
+        ("upstream", UPSTREAM.stats), ("storage", STORAGE_BUDGET.stats),
+        ("sqlite", SQLITE_POOL.stats), ("shared", SHARED_TABLES.stats),
+    ]
+
+
 @app.route("/<accession>/", methods=["GET"])
 def glds_summary(accession):
     """Report factors, assays, and/or raw JSON"""
     rargs = parse_rargs(request.args)
     try:
-        glds = GLDS(accession, get_json=get_json)
+        glds = GLDS_CACHE.get(accession, get_json=get_json)
     except GeneLabJSONException as e:
         raise FileNotFoundError(e)
+    etag = get_etag("summary", accession, glds.date, canonical_rargs(rargs))
+    not_modified = check_not_modified(etag, glds.date)
+    if not_modified is not None:
+        return not_modified
     if rargs.display_rargs["fmt"] == "raw":
-        return display_object([glds._json], {"fmt": "json"})
+        response = display_object([glds._json], {"fmt": "json"})
     else:
-        return display_object(
+        response = display_object(
             glds.summary_dataframe, rargs.display_rargs
         )
+    return set_validators(response, etag, glds.date)
 
 
 @app.route("/<accession>/<assay_name>/", methods=["GET", "POST"])
@@ -99,23 +187,30 @@ def assay_factors(accession, assay_name):
     assay, message, status = get_assay(accession, assay_name, rargs, get_json)
     if assay is None:
         return message, status
-    else:
-        if rargs.non_data_rargs["cls"]:
-            if rargs.display_rargs["fmt"] != "tsv":
-                error_mask = "{} format is unsuitable for CLS (use tsv)"
-                raise GeneLabException(
-                    error_mask.format(rargs.display_rargs["fmt"])
-                )
-            else:
-                obj = assay.factors(
-                    cls=rargs.non_data_rargs["cls"],
-                    continuous=rargs.non_data_rargs["continuous"]
-                )
-                return display_object(obj, {"fmt": "raw"})
+    date = assay.parent.date
+    etag = get_etag(
+        "factors", accession, assay.name, date, canonical_rargs(rargs)
+    )
+    not_modified = check_not_modified(etag, date)
+    if not_modified is not None:
+        return not_modified
+    if rargs.non_data_rargs["cls"]:
+        if rargs.display_rargs["fmt"] != "tsv":
+            error_mask = "{} format is unsuitable for CLS (use tsv)"
+            raise GeneLabException(
+                error_mask.format(rargs.display_rargs["fmt"])
+            )
         else:
-            return display_object(
-                assay.factors(), rargs.display_rargs, index=True
+            obj = assay.factors(
+                cls=rargs.non_data_rargs["cls"],
+                continuous=rargs.non_data_rargs["continuous"]
             )
+            response = display_object(obj, {"fmt": "raw"})
+    else:
+        response = display_object(
+            assay.factors(), rargs.display_rargs, index=True
+        )
+    return set_validators(response, etag, date)
 
 
 @app.route("/<accession>/<assay_name>/annotation/", methods=["GET"])
@@ -125,91 +220,187 @@ def assay_annotation(accession, assay_name):
     assay, message, status = get_assay(accession, assay_name, rargs, get_json)
     if assay is None:
         return message, status
-    else:
-        if rargs.non_data_rargs["cls"]:
-            if rargs.display_rargs["fmt"] != "tsv":
-                error_mask = "{} format is unsuitable for CLS (use tsv)"
-                raise GeneLabException(
-                    error_mask.format(rargs.display_rargs["fmt"])
-                )
-            else:
-                annotation = assay.annotation(
-                    differential_annotation=rargs.non_data_rargs["diff"],
-                    named_only=rargs.non_data_rargs["named_only"],
-                    cls=rargs.non_data_rargs["cls"],
-                    continuous=rargs.non_data_rargs["continuous"]
-                )
-                return display_object(annotation, {"fmt": "raw"})
+    date = assay.parent.date
+    etag = get_etag(
+        "annotation", accession, assay.name, date, canonical_rargs(rargs)
+    )
+    not_modified = check_not_modified(etag, date)
+    if not_modified is not None:
+        return not_modified
+    if rargs.non_data_rargs["cls"]:
+        if rargs.display_rargs["fmt"] != "tsv":
+            error_mask = "{} format is unsuitable for CLS (use tsv)"
+            raise GeneLabException(
+                error_mask.format(rargs.display_rargs["fmt"])
+            )
         else:
             annotation = assay.annotation(
                 differential_annotation=rargs.non_data_rargs["diff"],
-                named_only=rargs.non_data_rargs["named_only"]
-            )
-            return display_object(
-                annotation, rargs.display_rargs, index=True
+                named_only=rargs.non_data_rargs["named_only"],
+                cls=rargs.non_data_rargs["cls"],
+                continuous=rargs.non_data_rargs["continuous"]
             )
+            response = display_object(annotation, {"fmt": "raw"})
+    else:
+        annotation = assay.annotation(
+            differential_annotation=rargs.non_data_rargs["diff"],
+            named_only=rargs.non_data_rargs["named_only"]
+        )
+        response = display_object(
+            annotation, rargs.display_rargs, index=True
+        )
+    return set_validators(response, etag, date)
 
 
 @app.route("/<accession>/<assay_name>/data/", methods=["GET"])
 def get_data(accession, assay_name, rargs=None, return_raw=False):
     """Serve any kind of data"""
     if rargs is None:
-        rargs = parse_rargs(request.args)
+        rargs = parse_rargs(request.args, request.accept_mimetypes)
     assay, message, status = get_assay(accession, assay_name, rargs, get_json)
     if assay is None:
         return message, status
     filename = resolve_file_name(assay, rargs)
-    table_data = try_sqlite(
-        accession, assay.name, rargs.data_rargs,
-        expect_date=assay.glds_file_dates.get(filename, -1)
+    is_melted = rargs.data_rargs["melted"] or rargs.data_rargs["descriptive"]
+    # melted/descriptive views are derived on the fly, only the matrix is stored:
+    base_data_rargs = {
+        **rargs.data_rargs, "melted": False, "descriptive": False
+    }
+    table_name = data_rargs_digest(base_data_rargs)
+    expect_date = assay.glds_file_dates.get(filename, -1)
+    if not return_raw: # melted views also depend on the annotation:
+        date = assay.parent.date if is_melted else expect_date
+        etag = get_etag(
+            "data", accession, assay.name, filename, date,
+            canonical_rargs(rargs)
+        )
+        not_modified = check_not_modified(etag, date)
+        if not_modified is not None:
+            return not_modified
+        rendered = RESPONSE_CACHE.get(etag, accession)
+        if rendered is not None:
+            return set_validators(rendered_response(rendered), etag, date)
+    top = None if return_raw else rargs.display_rargs["top"]
+    if return_raw:
+        page = None
+    else: # cursors are only valid for the same rows in the same order:
+        fingerprint = get_page_fingerprint(
+            data_rargs_digest(rargs.data_rargs), expect_date,
+            rargs.data_filter_rargs, top
+        )
+        page = parse_page(rargs.display_rargs, fingerprint)
+    query = plan_query(rargs.data_filter_rargs, top=top, page=page)
+    is_passthrough = (rargs.display_rargs["fmt"] == "arrow") and (
+        query is None) and (not is_melted) and (not return_raw) and (
+        rargs.display_rargs["showcol"] is None) and (
+        rargs.display_rargs["hidecol"] is None) and (
+        not rargs.display_rargs["header"]
     )
-    if table_data is None:
-        table_data = retrieve_table_data(assay, filename, rargs.data_rargs)
-        dump_to_sqlite(
-            accession, assay.name, rargs.data_rargs, table_data,
-            set_date=assay.glds_file_dates.get(filename, -1)
+    if is_passthrough: # serve stored record batches without re-encoding
+        stored_stream = try_arrow_stream(
+            accession, assay.name, table_name, expect_date
+        )
+        if stored_stream is not None:
+            return set_validators(Response(
+                stored_stream, mimetype=BINARY_FMT_MIMETYPES["arrow"]
+            ), etag, date)
+    if (query is None) or is_melted:
+        filtered_table_data = None
+    else: # try to filter, sort, limit and page inside the table store:
+        filtered_table_data = query_cache(
+            accession, assay.name, table_name, expect_date, query
+        )
+    if filtered_table_data is None:
+        table_data = try_cache_or_make(
+            accession, assay.name, table_name, expect_date,
+            make_table=lambda: retrieve_table_data(
+                assay, filename, base_data_rargs
+            )
+        )
+        if is_melted:
+            can_stream = (not return_raw) and (page is None) and (
+                rargs.data_filter_rargs["sort_by"] is None
+            ) and (rargs.display_rargs["fmt"] in {"tsv", "json"})
+            melted_blocks = iterate_melted_blocks(
+                table_data, assay, rargs.data_rargs
+            ) if can_stream else None
+            if melted_blocks is not None:
+                if rargs.data_filter_rargs["filter"] is not None:
+                    melted_blocks = iterate_filtered_blocks(
+                        melted_blocks, rargs.data_filter_rargs["filter"]
+                    )
+                return remember_response(display_object(
+                    melted_blocks, rargs.display_rargs, index="auto"
+                ), etag, date, accession)
+            table_data = melt_formatted_table(
+                table_data, assay, rargs.data_rargs
+            )
+        filtered_table_data = filter_table_data(
+            table_data, rargs.data_filter_rargs, top=top
         )
-    filtered_table_data = filter_table_data(table_data, rargs.data_filter_rargs)
+        if page is not None:
+            query.set_total_count(filtered_table_data.shape[0])
+            start, stop = query.row_range
+            filtered_table_data = filtered_table_data.iloc[start:stop]
     if return_raw:
         return filtered_table_data
-    elif rargs.display_rargs["fmt"] in {"tsv", "json"}:
-        return display_object(
+    elif rargs.display_rargs["fmt"] in {"tsv", "json", *BINARY_FMT_MIMETYPES}:
+        response = display_object(
             filtered_table_data, rargs.display_rargs, index="auto"
         )
+        if page is not None:
+            response.headers["X-Total-Count"] = str(query.total_count)
+            next_cursor = get_next_cursor(*page, query.total_count, fingerprint)
+            if next_cursor is not None:
+                response.headers["X-Next-Cursor"] = next_cursor
+        return remember_response(response, etag, date, accession)
     else:
         raise NotImplementedError("fmt={}".format(rargs.display_rargs["fmt"]))
 
 
 def get_gct(accession, assay_name, rargs):
-    """Get GCT formatted processed data; needs to be refactored!"""
+    """Stream GCT formatted processed data; unfiltered GCTs are stored and reused"""
     assay, message, status = get_assay(accession, assay_name, rargs, get_json)
     if assay is None:
         return message, status
+    etag = get_etag(
+        "gct", accession, assay.name, assay.parent.date, canonical_rargs(rargs)
+    )
+    not_modified = check_not_modified(etag, assay.parent.date)
+    if not_modified is not None:
+        return not_modified
+    samples = list(assay.annotation().index)
+    is_unfiltered = (rargs.data_filter_rargs["filter"] is None) and (
+        rargs.data_filter_rargs["sort_by"] is None
+    )
+    if is_unfiltered:
+        filename = resolve_file_name(assay, rargs)
+        gct_file = get_artifact_file_name(
+            accession, assay.name, data_rargs_digest(rargs.data_rargs), "gct",
+            key=(assay.glds_file_dates.get(filename, -1), samples)
+        )
+        gct_data = try_artifact(gct_file)
+        if gct_data is not None:
+            return set_validators(
+                streaming_response(gct_data, mimetype="application"),
+                etag, assay.parent.date
+            )
     pdata = get_data(accession, assay.name, rargs=rargs, return_raw=True)
     if isinstance(pdata, DataFrame):
-        # ensure that order of columns matches order of samples in annotation:
-        pdc, aai = pdata.columns, assay.annotation().index
-        pdcs, aais = set(pdc), set(aai)
-        if aais - pdcs:
-            raise GeneLabException(
-                "Sample names are present in the annotation but not in the GCT",
-                sorted(aais - pdcs)
-            )
-        pdata = pdata[
-            [c for c in pdc if c not in aais] + [c for c in aai if c in pdcs]
-        ]
-        gct_header = "#1.2\n{}\t{}\n".format(pdata.shape[0], pdata.shape[1]-1)
-        pdata.columns = ["Description"] + list(pdata.columns)[1:]
-        pdata.insert(loc=0, column="Name", value=pdata["Description"])
-        gct_data = gct_header + pdata.to_csv(sep="\t", index=False)
-        return display_object(gct_data, {"fmt": "raw"})
+        gct_data = stream_gct(pdata, samples)
+        if is_unfiltered:
+            gct_data = tee_to_artifact(gct_data, gct_file)
+        return set_validators(
+            streaming_response(gct_data, mimetype="application"),
+            etag, assay.parent.date
+        )
     else:
         raise TypeError("Unexpected type: expected `DataFrame`")
 
 
 def assess_data_alias(data_type, rargs, transform):
     """Checks if the URL alias is resolvable"""
-    if data_type in {"processed", "deg", "viz-table", "pca"}:
+    if data_type in DATA_ALIASES:
         are_fields_dirty = (rargs.data_rargs["fields"] is not None)
         is_file_filter_dirty = (rargs.data_rargs["file_filter"] != ".*")
         if are_fields_dirty or is_file_filter_dirty:
@@ -245,11 +436,8 @@ def assess_data_alias(data_type, rargs, transform):
         return GeneLabException(error_mask.format(transform))
 
 
-def get_data_alias_helper(accession, assay_name, data_type, rargs, transform=None):
-    """Dispatch data for URL aliases"""
-    AssessmentError = assess_data_alias(data_type, rargs, transform)
-    if AssessmentError is not None:
-        raise AssessmentError
+def get_alias_rargs(data_type, rargs):
+    """Set 'fields' and 'file_filter' that select the file of a data alias"""
     modified_rargs = deepcopy(rargs)
     if data_type == "processed":
         modified_rargs.data_rargs["file_filter"] = PROCESSED_XSV_REGEX
@@ -260,10 +448,19 @@ def get_data_alias_helper(accession, assay_name, data_type, rargs, transform=Non
         modified_rargs.data_rargs["fields"] = False # skip metadata check
         modified_rargs.data_rargs["file_filter"] = VIZ_CSV_REGEX
     elif data_type == "pca":
-        if transform == "melted":
-            transform = None
         modified_rargs.data_rargs["fields"] = False # skip metadata check
         modified_rargs.data_rargs["file_filter"] = PCA_CSV_REGEX
+    return modified_rargs
+
+
+def get_data_alias_helper(accession, assay_name, data_type, rargs, transform=None):
+    """Dispatch data for URL aliases"""
+    AssessmentError = assess_data_alias(data_type, rargs, transform)
+    if AssessmentError is not None:
+        raise AssessmentError
+    modified_rargs = get_alias_rargs(data_type, rargs)
+    if (data_type == "pca") and (transform == "melted"):
+        transform = None
     if transform == "gct":
         return get_gct(accession, assay_name, modified_rargs)
     elif transform is not None:
@@ -274,14 +471,22 @@ def get_data_alias_helper(accession, assay_name, data_type, rargs, transform=Non
 @app.route("/<accession>/<assay_name>/data/<data_type>/", methods=["GET"])
 def get_data_plain_alias(accession, assay_name, data_type):
     """Alias 'processed', 'deg', and 'viz-table' endpoints"""
-    rargs = parse_rargs(request.args)
+    rargs = parse_rargs(request.args, request.accept_mimetypes)
     return get_data_alias_helper(accession, assay_name, data_type, rargs)
 
 
 @app.route("/<accession>/<assay_name>/data/<data_type>/<transform>/", methods=["GET"])
 def get_data_transformed_alias(accession, assay_name, data_type, transform):
     """Alias 'melted', 'descriptive', and 'gct' endpoints"""
-    rargs = parse_rargs(request.args)
+    rargs = parse_rargs(request.args, request.accept_mimetypes)
     return get_data_alias_helper(
         accession, assay_name, data_type, rargs, transform
     )
+
+
+@app.after_request
+def vary_on_accept(response):
+    """Data responses depend on Accept if fmt was negotiated rather than passed"""
+    if (request.endpoint in FMT_NEGOTIATING_ENDPOINTS) and ("fmt" not in request.args):
+        response.vary.add("Accept")
+    return response
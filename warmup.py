@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+from sys import stderr, exit
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time
+from gf import get_json, get_alias_rargs, DATA_ALIASES
+from genefab import GeneLabException
+from genefab._util import DEFAULT_RARGS, data_rargs_digest
+from genefab._dataset import get_datasets
+from genefab._cache import GLDS_CACHE
+from genefab._bridge import resolve_file_name
+from genefab._storage import is_cached, try_cache_or_make, retrieve_table_data
+
+
+DEFAULT_JOBS = 4
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = ArgumentParser(
+        description="Prefetch processed, deg, viz-table and pca tables " +
+        "of whole datasets into the table store"
+    )
+    parser.add_argument(
+        "accessions", metavar="ACCESSION", nargs="*",
+        help="dataset accession, such as GLDS-4"
+    )
+    parser.add_argument(
+        "-q", "--query", metavar="FIELD=REGEX", action="append", default=[],
+        help="add datasets matching ffield value regex (e.g. organism=Mus)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=DEFAULT_JOBS,
+        help="number of parallel workers (default: {})".format(DEFAULT_JOBS)
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="also report tables that are already current"
+    )
+    args = parser.parse_args()
+    if (not args.accessions) and (not args.query):
+        parser.error("pass at least one ACCESSION or --query")
+    return args
+
+
+def expand_queries(queries, verbose=False):
+    """Convert FIELD=REGEX pairs to matching dataset accessions"""
+    ffield_kwargs = {}
+    for query in queries:
+        ffield_alias, _, ffregex = query.partition("=")
+        ffield_kwargs[ffield_alias] = ffregex
+    return get_datasets(get_json, verbose=verbose, **ffield_kwargs)
+
+
+def resolve_targets(accession):
+    """Find files of all data aliases in all assays of a dataset"""
+    glds = GLDS_CACHE.get(accession, get_json=get_json)
+    targets = []
+    for assay in glds.assays.values():
+        for data_type in DATA_ALIASES:
+            rargs = get_alias_rargs(data_type, DEFAULT_RARGS)
+            try:
+                filename = resolve_file_name(assay, rargs)
+            except (FileNotFoundError, ValueError, IndexError, KeyError):
+                continue
+            targets.append((assay, data_type, rargs, filename))
+    return targets
+
+
+def warm_table(assay, rargs, filename):
+    """Fill table cache unless stored date is current; report size and time"""
+    accession = assay.parent.accession
+    table_name = data_rargs_digest(rargs.data_rargs)
+    expect_date = assay.glds_file_dates.get(filename, -1)
+    if is_cached(accession, assay.name, table_name, expect_date):
+        return "current", 0, 0
+    start = time()
+    table_data = try_cache_or_make(
+        accession, assay.name, table_name, expect_date,
+        make_table=lambda: retrieve_table_data(
+            assay, filename, rargs.data_rargs
+        )
+    )
+    nbytes = int(table_data.memory_usage(index=True, deep=True).sum())
+    return "filled", nbytes, time() - start
+
+
+def main(args):
+    """Resolve targets and fill the table cache with a bounded worker pool"""
+    accessions = list(args.accessions)
+    if args.query:
+        accessions.extend(expand_queries(args.query, verbose=args.verbose))
+    accessions = sorted(set(accessions))
+    print("warming up {} dataset(s)".format(len(accessions)), file=stderr)
+    counts = {"filled": 0, "current": 0, "failed": 0}
+    total_bytes, start = 0, time()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        targets = []
+        resolvers = {pool.submit(resolve_targets, a): a for a in accessions}
+        for future in as_completed(resolvers):
+            try:
+                targets.extend(future.result())
+            except (GeneLabException, OSError, ValueError) as e:
+                print("failed to resolve", resolvers[future], e, file=stderr)
+        warmers = {
+            pool.submit(warm_table, assay, rargs, filename):
+                (assay, data_type)
+            for assay, data_type, rargs, filename in targets
+        }
+        for done, future in enumerate(as_completed(warmers), start=1):
+            assay, data_type = warmers[future]
+            prefix = "[{}/{}] {} {} {}:".format(
+                done, len(warmers), assay.parent.accession, assay.name,
+                data_type
+            )
+            try:
+                status, nbytes, elapsed = future.result()
+            except Exception as e:
+                counts["failed"] += 1
+                print(prefix, "failed ({}: {})".format(
+                    type(e).__name__, e
+                ), file=stderr)
+                continue
+            counts[status] += 1
+            total_bytes += nbytes
+            if status == "filled":
+                print(prefix, "{:.1f} MB in {:.1f} s".format(
+                    nbytes / 2**20, elapsed
+                ), file=stderr)
+            elif args.verbose:
+                print(prefix, "already current", file=stderr)
+    elapsed = time() - start
+    print(
+        "filled {filled}, already current {current}, failed {failed};".format(
+            **counts
+        ),
+        "{:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+            total_bytes / 2**20, elapsed, total_bytes / 2**20 / (elapsed or 1)
+        ),
+        file=stderr
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    exit(main(parse_args()))